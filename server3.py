@@ -18,21 +18,45 @@
 #  FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 #  DEALINGS IN THE SOFTWARE.
 
+import asyncio # serves HTTP connections from a single event loop
+import base64 # encodes the key that accepts a WebSocket handshake
+import bisect # keeps the price levels of a book side in sorted order without re-sorting
 import csv # working with comma-separated value (CSV) files -> storing and exchanging data in a tabular format
+import hashlib # hashes the order history, to tell whether its binary cache is stale
 # from BaseHTTPServer import BaseHTTPRequestHandler,HTTPServer
 import http.server # serve HTTP requests, including handling GET and POST requests
 import json # encoding and decoding data in JSON
+import math # tells the NaN price of a missing quote in the binary formats
+import mmap # maps the top of book tape into memory for sessions to read
 import operator # set of functions for performing common operations on Python objects
 import os.path # provides functions for manipulating file paths and directories in a platform-independent way
+import queue # bounded queue of connections waiting for a pooled worker
 import re # provides regular expression matching operations
+import shutil # copies the column files into the binary cache
+import socket # listening socket handed to the asyncio server
+import struct # packs the header of the binary cache
+import sys # command line of the server
+import tempfile # scratch files for the columns while the binary cache is built
 import threading # creating and managing threads in Python, which are used for parallel execution of code
-from datetime import timedelta, datetime # provides classes for manipulating dates and times in both simple and complex ways
+import time # monotonic clock that paces the sim
+import traceback # reports errors raised by a route on the asyncio server
+from array import array # compact typed columns for the binary cache
+from collections import deque, namedtuple, OrderedDict # double-ended queue, holds the orders resting at one price level
+from datetime import timedelta, datetime, timezone # provides classes for manipulating dates and times in both simple and complex ways
+from itertools import islice # lazily skips the orders a clearing pass has consumed
 # from itertools import izip
-from random import normalvariate, random # normalvariate generates random numbers from a normal distribution with a specified mean and standard deviation, while random generates random numbers between 0 and 1.
+from concurrent.futures import ProcessPoolExecutor # runs the shards of generate_csv() in parallel
+from random import normalvariate, random, seed as random_seed # normalvariate generates random numbers from a normal distribution with a specified mean and standard deviation, while random generates random numbers between 0 and 1.
 from socketserver import ThreadingMixIn # A mix-in is a way of adding functionality to a class by inheriting from it without defining a new subclass
+from urllib.parse import parse_qsl # decodes query strings into their parameters
 
 import dateutil.parser # This module provides functions for parsing dates and times in various formats, including ISO 8601 format
 
+try:
+    import numpy # optional, only the batched test data generator needs it
+except ImportError:
+    numpy = None
+
 ################################################################################
 #
 # Config
@@ -40,6 +64,9 @@ import dateutil.parser # This module provides functions for parsing dates and ti
 # Sim params
 
 REALTIME = True
+REPLAY = False  # serve the top of book tape built from the orders, instead of matching them
+CHECKPOINT_EVERY = 10000  # orders between the checkpoints a restarted engine resumes from, None for none
+SIM_SPEED = 60 * 60 * 24  # sim seconds per real second when REALTIME
 SIM_LENGTH = timedelta(days=365 * 5) # The timedelta() constructor creates a timedelta object that represents a duration of time
 # set the time when the market opens -> 00:30:00
 MARKET_OPEN = datetime.today().replace(hour=0, minute=30, second=0) # The replace() method is used to modify the hour, minute, and second components of the datetime object without changing the other components, such as the year, month, and day
@@ -65,6 +92,26 @@ FREQ = (12, 36, 50)    # frequency of trades
 # Trades
 
 OVERLAP = 4
+STOCKS = ('ABC', 'DEF')
+
+# Server
+
+WORKERS = 16  # threads serving HTTP requests, None for a thread per request
+QUEUE_SIZE = 64  # connections that may wait for a worker before getting a 503
+BACKEND = 'threads'  # or 'asyncio', one event loop serving keep-alive connections
+KEEP_ALIVE = 60  # seconds an idle keep-alive connection is held open
+POOL_KEEP_ALIVE = 5  # seconds a pooled worker waits on an idle keep-alive connection
+SESSIONS = 10000  # replay sessions kept for clients, the least recently used are dropped
+HEARTBEAT = 15  # seconds between comments sent down an idle event stream
+STREAMS = 8  # event streams, WebSockets and long polls the pooled server holds open, each on a worker; kept below WORKERS
+LONG_POLL = 30  # most seconds a /query?after= waits for a newer snapshot
+BATCH = 1000  # most snapshots a /query?n= answers with
+HISTORY_LIMIT = 1000  # most quotes on a page of /history
+
+# Order Book
+
+ORDER_TTL = 10  # orders a side takes before one expires, or a timedelta of sim time
+LEVEL_SWEEP = 16  # orders per price level from which clear() sweeps whole levels rather than single orders
 
 
 ################################################################################
@@ -148,6 +195,59 @@ def orders(hist):
         # if return  -> random() always return the same value :( (cuz random is not really random: it's pseudo-random with a seed)
 
 
+# Batched versions of bwalk(), market() and orders(), drawing whole blocks
+# of numpy arrays from a seeded Generator.
+
+BLOCK = 1 << 20
+
+
+def bwalk_block(steps, min, max, x):
+    """ Bounded random walk over an array of normal steps, continuing from
+        the unbounded position x.  Returns (walk, new x), with x folded back
+        into one period so it doesn't drift.
+    """
+    rng = max - min
+    x = x + numpy.cumsum(steps)
+    return numpy.abs((x % (rng * 2)) - rng) + min, x[-1] % (rng * 2)
+
+
+def market_blocks(rng, t0=MARKET_OPEN, block=BLOCK):
+    """ Generates blocks of market conditions as arrays (time, price,
+        spread), distributed like market().  Times are datetime64[us].
+    """
+    walks = (FREQ, PX, SPD)
+    xs = [max for _, max, _ in walks]
+    t = numpy.datetime64(t0, 'us')
+    while True:
+        blocks = []
+        for i, (min, max, std) in enumerate(walks):
+            walk, xs[i] = bwalk_block(rng.normal(0, std, block), min, max, xs[i])
+            blocks.append(walk)
+        hours, px, spd = blocks
+        steps = numpy.rint(numpy.abs(hours) * 3.6e9).astype(numpy.int64)
+        offsets = numpy.cumsum(steps)
+        times = t + (offsets - steps).astype('timedelta64[us]')
+        t += offsets[-1].astype('timedelta64[us]')
+        yield times, px, spd
+
+
+def order_blocks(seed=None, t0=MARKET_OPEN, block=BLOCK):
+    """ Generates blocks of random limit orders as arrays (time, stock,
+        side, price, size), distributed like orders(market()).  Stocks index
+        STOCKS and sides index SIDES.  The same seed gives the same orders.
+    """
+    if numpy is None:
+        raise ImportError('order_blocks() needs numpy')
+    rng = numpy.random.default_rng(seed)
+    for t, px, spd in market_blocks(rng, t0, block):
+        stock = (rng.random(block) <= 0.5).astype(numpy.uint8)
+        sell = rng.random(block) > 0.5
+        d = numpy.where(sell, 2, -2)
+        price = numpy.round(rng.normal(px + spd / d, spd / OVERLAP), 2)
+        size = numpy.abs(rng.normal(0, 100, block)).astype(numpy.int64)
+        yield t, stock, sell.astype(numpy.uint8), price, size
+
+
 ################################################################################
 #
 # Order Book
@@ -166,68 +266,1516 @@ def add_book(book, order, size, _age=10):
         By decrementing the age of each order in the book by 1, the add_book function simulates the passage of time and the decreasing likelihood that an order will be filled.
     """
 
-def clear_order(order, size, book, op=operator.ge, _notional=0):
+def clear_order(order, size, book, op=operator.ge):
     """ Try to clear a sized order against a book, returning a tuple of
-        (notional, new_book) if successful, and None if not.  _notional is a
-        recursive accumulator and should not be provided by the caller.
+        (notional, book) if successful, and None if not.  The book is updated
+        in place, and only when the order clears.
+
+        This and clear_book() match plain sorted lists of (price, size, age)
+        orders, the matching order_book() is defined by.  The server does not
+        call them: it matches with OrderBook.clear(), which gives the same
+        books without changing its resting orders.
     """
-    (top_order, top_size, age), tail = book[0], book[1:]
-    if op(order, top_order):
-        _notional += min(size, top_size) * top_order
-        sdiff = top_size - size
-        if sdiff > 0:
-            return _notional, list(add_book(tail, top_order, sdiff, age))
-        elif len(tail) > 0:
-            return clear_order(order, -sdiff, tail, op, _notional)
+    notional = 0
+    for i, (top_order, top_size, age) in enumerate(book):
+        if not op(order, top_order):
+            return
+        notional += min(size, top_size) * top_order
+        if top_size > size:
+            book[i + 1:] = [(o, s, a - 1) for o, s, a in islice(book, i + 1, None) if a > 0]
+            book[i] = top_order, top_size - size, age
+            del book[:i]
+            return notional, book
+        size -= top_size
 
 
 def clear_book(buy=None, sell=None):
-    """ Clears all crossed orders from a buy and sell book, returning the new
-        books uncrossed.
-    """
-    while buy and sell:
-        order, size, _ = buy[0]
-        new_book = clear_order(order, size, sell)
-        if new_book:
-            sell = new_book[1]
-            buy = buy[1:]
-        else:
-            break
+    """ Clears all crossed orders from a buy and sell book, returning the
+        books uncrossed.  Both books are updated in place.
+    """
+    filled = 0
+    if buy and sell:
+        for order, size, _ in buy:
+            if clear_order(order, size, sell) is None:
+                break
+            filled += 1
+        del buy[:filled]
     return buy, sell
 
 
+class BookSide(object):
+    """ One side of an order book, grouped into price levels.  The level
+        prices are kept in a bisect-maintained list with the best level last,
+        and each level is a deque of [price, size, expiry] orders with the
+        most recent order at the front; the same priority sorted() used to
+        give orders resting at the same price.
+
+        Orders expire lazily.  With an integer ttl the side's clock counts
+        the orders added to it, as add_book() aged them; with a timedelta it
+        is the sim time.  Every order shares the same ttl, so orders expire
+        in the order they were added and a queue in insertion sequence is
+        all the timer needed: expiring pops its head, and the order is always
+        the oldest one, at the back of its level.
+
+        Each level also keeps the running sum of its sizes in insertion
+        order, so the shares of its best orders are a subtraction and the
+        number of orders it takes to make up some shares is a bisect.
+    """
+
+    def __init__(self, side, ttl=10):
+        self._sign = 1 if side == 'buy' else -1
+        self._ttl = ttl
+        self._counted = not isinstance(ttl, timedelta)
+        self._now = 0 if self._counted else None
+        self._keys = []
+        self._levels = {}
+        self._sums = {}
+        self._queue = deque()
+
+    def add(self, order, size, t=None):
+        """ Rest a new order on its price level, creating the level if
+            needed.  Counting the order ages the rest of the side.
+        """
+        if self._counted:
+            self._now += 1
+            self._expire()
+        elif self._now is None:
+            self._now = t
+        self._rest([order, size, (self._now if self._counted else t) + self._ttl])
+
+    def _rest(self, o):
+        key = self._sign * o[0]
+        level = self._levels.get(key)
+        if level is None:
+            level = self._levels[key] = deque()
+            self._sums[key] = [0]
+            bisect.insort(self._keys, key)
+        level.appendleft(o)
+        sums = self._sums[key]
+        sums.append(sums[-1] + o[1])
+        self._queue.append(o)
+
+    def advance(self, t):
+        """ Move the sim clock to t, expiring the orders due by then. """
+        if not self._counted:
+            self._now = t
+            self._expire()
+
+    def _expire(self):
+        queue, now = self._queue, self._now
+        while queue and queue[0][2] < now:
+            o = queue.popleft()
+            key = self._sign * o[0]
+            level = self._levels[key]
+            level.pop()
+            if not level:
+                self._remove_level(key)
+            elif len(self._sums[key]) > 2 * len(level) + 64:
+                sums = self._sums[key] = [0]
+                for o in reversed(level):
+                    sums.append(sums[-1] + o[1])
+
+    def _remove_level(self, key):
+        del self._levels[key]
+        del self._sums[key]
+        del self._keys[bisect.bisect_left(self._keys, key)]
+
+    def state(self):
+        """ The clock of the side and its resting [price, size, expiry]
+            orders, oldest first, as restore() takes them.
+        """
+        return self._now, [tuple(o) for o in self._queue]
+
+    def restore(self, now, orders):
+        """ Rests the orders of a state() again on an empty side. """
+        self._now = now
+        for order, size, expiry in orders:
+            self._rest([order, size, expiry])
+
+    def _orders(self):
+        """ Yields the resting (price, size, age) orders, best first.  The
+            age is what is left of the ttl: a count of orders, or a
+            timedelta.
+        """
+        now = self._now
+        for key in reversed(self._keys):
+            for o, s, expiry in self._levels[key]:
+                yield o, s, expiry - now
+
+    def _shares(self, key, count):
+        """ The shares of the best `count` orders of a level. """
+        sums = self._sums[key]
+        return sums[-1] - sums[-1 - count]
+
+    def _depth(self, key, shares, bisect=bisect.bisect_right):
+        """ The number of best orders of a level that add up to less than
+            `shares`, or with bisect_left to no more than `shares`.
+        """
+        sums = self._sums[key]
+        hi = len(sums) - 1
+        return hi - bisect(sums, sums[hi] - shares, hi - len(self._levels[key]), hi)
+
+    def top(self):
+        """ Returns the best (price, size, age), or None if the side is empty. """
+        if self._keys:
+            o, s, expiry = self._levels[self._keys[-1]][0]
+            return o, s, expiry - self._now
+
+    def __iter__(self):
+        return self._orders()
+
+    def __len__(self):
+        return len(self._queue)
+
+
+class BookView(object):
+    """ A cleared view of a book side, as clear_book() would return it: the
+        first `skip` orders are consumed, `head` replaces the order a partial
+        fill stopped on, and the orders after it have aged by `rounds` (only
+        when the ttl counts orders).
+
+        Only the top of the view is computed up front, the rest is read
+        lazily from the side, so a view is only valid until the next order
+        is added to the book.
+    """
+
+    def __init__(self, side, top, head=None, skip=0, rounds=0):
+        self._side = side
+        self._top = top
+        self._head = head
+        self._skip = skip
+        self._rounds = rounds
+
+    def __iter__(self):
+        if self._head is not None:
+            yield self._head
+        rounds = self._rounds
+        for o, s, age in islice(self._side._orders(), self._skip, None):
+            if not rounds:
+                yield o, s, age
+            elif age >= rounds:
+                yield o, s, age - rounds
+
+    def __getitem__(self, index):
+        if index == 0 and self._top is not None:
+            return self._top
+        if isinstance(index, slice):
+            return list(self)[index]
+        for i, o in enumerate(self):
+            if i == index:
+                return o
+        raise IndexError('book view index out of range')
+
+    def __bool__(self):
+        return self._top is not None
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class OrderBook(object):
+    """ Book of resting orders for one stock.  Adding an order costs a bisect
+        into the price levels of its side instead of a re-sort, and clear()
+        only walks the part of the book that is actually crossed.
+    """
+
+    def __init__(self, ttl=ORDER_TTL):
+        self._ttl = ttl
+        self._counted = not isinstance(ttl, timedelta)
+        self._sides = {}
+
+    def add(self, side, order, size, t=None):
+        """ Add a new order and size to a side of the book.  The sim time t is
+            only needed when the ttl is a timedelta.
+        """
+        book = self._sides.get(side)
+        if book is None:
+            book = self._sides[side] = BookSide(side, self._ttl)
+        book.add(order, size, t)
+
+    def advance(self, t):
+        """ Move the sim clock to t, expiring the orders due by then. """
+        for book in self._sides.values():
+            book.advance(t)
+
+    def state(self):
+        """ The BookSide.state() of every side, by side. """
+        return {side: book.state() for side, book in self._sides.items()}
+
+    def restore(self, sides):
+        for side, (now, orders) in sides.items():
+            book = self._sides[side] = BookSide(side, self._ttl)
+            book.restore(now, orders)
+
+    def clear(self):
+        """ Returns the (bids, asks) views clear_book() would produce for this
+            book.  Like order_book() always did, the resting book itself is
+            left uncleared, so each event clears the whole crossed book again.
+            Deep books are cleared a price level at a time, so that costs the
+            crossed levels rather than the crossed orders.
+        """
+        buy, sell = self._sides.get('buy'), self._sides.get('sell')
+        if not buy or not sell:
+            return self._view(buy), self._view(sell)
+        if len(buy) + len(sell) < LEVEL_SWEEP * (len(buy._keys) + len(sell._keys)):
+            return self._clear_orders(buy, sell)
+        return self._clear_levels(buy, sell)
+
+    def _clear_orders(self, buy, sell):
+        """ Clears the book an order at a time, cheapest while levels are
+            short.
+        """
+        asks = sell._orders()
+        seen = []
+
+        def ask(i):
+            while len(seen) <= i:
+                o = next(asks, None)
+                if o is None:
+                    return None
+                seen.append(o)
+            return seen[i]
+
+        top = ask(0)
+        stop, rounds, top_bid = None, 0, None
+        for o in buy._orders():
+            aged = rounds if self._counted else 0
+            swept = self._sweep(o[0], o[1], stop or (0,) + top, ask, aged)
+            if swept is None:
+                top_bid = o
+                break
+            stop = swept
+            rounds += 1
+        bids = BookView(buy, top_bid, skip=rounds)
+        if stop is None:
+            return bids, BookView(sell, top)
+        head = stop[1:]
+        return bids, BookView(sell, head, head, stop[0] + 1, rounds if self._counted else 0)
+
+    @staticmethod
+    def _sweep(order, size, stop, ask, rounds):
+        """ Sweeps a buy order through the asks, starting from the
+            (index, price, size, age) the last sweep stopped on.  Returns where
+            this one stops, or None if the order can't be filled, exactly
+            when clear_order() would.  Asks reached after `rounds` partial
+            fills have aged that many times, and the ones that didn't survive
+            it are skipped.
+        """
+        i, price, left, age = stop
+        while order >= price:
+            if left > size:
+                return i, price, left - size, age
+            size -= left
+            i += 1
+            o = ask(i)
+            while o is not None and rounds and o[2] < rounds:
+                i += 1
+                o = ask(i)
+            if o is None:
+                return None
+            price, left, age = o[0], o[1], o[2] - rounds if rounds else o[2]
+
+    def _clear_levels(self, buy, sell):
+        """ Clears the book a price level at a time.  A bid fills exactly when
+            the running shares of the bids up to it are fewer than the usable
+            asks priced at or under it, so the rounds come from walking the
+            bid levels down and the ask levels up together, and bisecting the
+            sums of the one level they stop in.  An ask is usable unless it
+            has aged out by the round that reaches it.  Within a level ages
+            fall as rounds rise, so the asks that have aged out are a tail of
+            it, found by bisecting too.
+        """
+        counted, now = self._counted, sell._now
+
+        # (key, orders before, shares before) of the levels walked so far,
+        # and the running shares at the end of each.
+        bid_keys, bids, bid_shares = reversed(buy._keys), [], []
+        ask_keys, asks, ask_shares, ask_prices = reversed(sell._keys), [], [], []
+
+        def bid_level(l):
+            while len(bids) <= l:
+                key = next(bid_keys, None)
+                if key is None:
+                    return False
+                count, shares = 0, 0
+                if bids:
+                    last = bids[-1][0]
+                    count, shares = bids[-1][1] + len(buy._levels[last]), bid_shares[-1]
+                bids.append((key, count, shares))
+                bid_shares.append(shares + buy._shares(key, len(buy._levels[key])))
+            return True
+
+        def round_of(shares):
+            """ The round filling when `shares` of usable asks are swept. """
+            l = bisect.bisect_left(bid_shares, shares)
+            while l == len(bid_shares):
+                if not bid_level(l):
+                    return len(buy)
+                if bid_shares[l] < shares:
+                    l += 1
+            key, count, before = bids[l]
+            return count + buy._depth(key, shares - before)
+
+        def usable(key, before):
+            """ The number of asks of a level that haven't aged out. """
+            level = sell._levels[key]
+            lo, hi = 0, len(level) - 1
+            if not counted or level[hi][2] - now >= round_of(before + sell._shares(key, hi)):
+                return hi + 1
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if level[mid][2] - now < round_of(before + sell._shares(key, mid)):
+                    hi = mid
+                else:
+                    lo = mid + 1
+            return lo
+
+        def absorb(key):
+            count, before = 0, 0
+            if asks:
+                last = asks[-1][0]
+                count, before = asks[-1][1] + len(sell._levels[last]), ask_shares[-1]
+            asks.append((key, count, before))
+            ask_shares.append(before + sell._shares(key, usable(key, before)))
+            ask_prices.append(-key)
+
+        ask_key = next(ask_keys, None)
+        l = 0
+        while bid_level(l):
+            key, count, before = bids[l]
+            while ask_key is not None and -ask_key <= key and not (ask_shares and ask_shares[-1] > bid_shares[l]):
+                absorb(ask_key)
+                ask_key = next(ask_keys, None)
+            m = bisect.bisect_right(ask_prices, key)
+            available = ask_shares[m - 1] if m else 0
+            if bid_shares[l] >= available:
+                filled = buy._depth(key, available - before)
+                rounds, spent = count + filled, before + buy._shares(key, filled)
+                o, s, expiry = buy._levels[key][filled]
+                top_bid = o, s, expiry - buy._now
+                break
+            l += 1
+        else:
+            rounds, spent, top_bid = len(buy), bid_shares[-1], None
+
+        cleared = BookView(buy, top_bid, skip=rounds)
+        if not rounds:
+            return cleared, BookView(sell, sell.top())
+        key, count, before = asks[bisect.bisect_right(ask_shares, spent)]
+        i = sell._depth(key, spent - before, bisect.bisect_left)
+        price, size, expiry = sell._levels[key][i]
+        age = expiry - now
+        if counted:
+            age -= round_of(before + sell._shares(key, i))
+        head = price, before + sell._shares(key, i + 1) - spent, age
+        return cleared, BookView(sell, head, head, count + i + 1, rounds if counted else 0)
+
+    @staticmethod
+    def _view(side):
+        if side is not None:
+            return BookView(side, side.top())
+
+
 def order_book(orders, book, stock_name):
-    """ Generates a series of order books from a series of orders.  Order books
-        are mutable lists, and mutating them during generation will affect the
-        next turn!
+    """ Generates a series of order books from a series of orders.  The book
+        is an OrderBook that is updated in place, and the bids and asks yielded
+        are views of it that are only valid until the next turn!
     """
     for t, stock, side, order, size in orders:
+        book.advance(t)
         if stock_name == stock:
-            new = add_book(book.get(side, []), order, size)
-            book[side] = sorted(new, reverse=side == 'buy', key=lambda x: x[0])
-        bids, asks = clear_book(**book)
+            book.add(side, order, size, t)
+        bids, asks = book.clear()
         yield t, bids, asks
 
 
+
+class Exchange(object):
+    """ Routes a single pass over a tape of orders to one OrderBook per stock,
+        so the tape is read once however many stocks it holds.  Only the book
+        an order is routed to does any work; the cleared views of the others
+        are kept until their book changes.
+    """
+
+    def __init__(self, ttl=ORDER_TTL):
+        self._ttl = ttl
+        self._counted = not isinstance(ttl, timedelta)
+        self._views = {}
+        self.books = {}
+        self.stocks = []
+        self.t = None
+
+    def add(self, t, stock, side, order, size):
+        """ Route one order to the book of its stock. """
+        book = self.books.get(stock)
+        if book is None:
+            book = self.books[stock] = OrderBook(self._ttl)
+            bisect.insort(self.stocks, stock)
+        book.advance(t)
+        book.add(side, order, size, t)
+        self._views.pop(stock, None)
+        self.t = t
+
+    def replay(self, orders):
+        """ Generates the time of every order as it is added to the books. """
+        for t, stock, side, order, size in orders:
+            self.add(t, stock, side, order, size)
+            yield t
+
+    def state(self):
+        """ The ttl, the time of the last order, and the OrderBook.state()
+            of every book by stock, as restore() takes them.
+        """
+        return self._ttl, self.t, {stock: book.state() for stock, book in self.books.items()}
+
+    @classmethod
+    def restore(cls, ttl, t, books):
+        """ An Exchange in the state() it was in. """
+        exchange = cls(ttl)
+        for stock, sides in books.items():
+            book = exchange.books[stock] = OrderBook(ttl)
+            book.restore(sides)
+            bisect.insort(exchange.stocks, stock)
+        exchange.t = t
+        return exchange
+
+    def clear(self, stock):
+        """ Returns the cleared (bids, asks) views of a stock as of the last
+            order, like order_book() yields them.
+        """
+        cached = self._views.get(stock)
+        if cached is not None and (self._counted or cached[0] == self.t):
+            return cached[1]
+        book = self.books.get(stock)
+        if book is None:
+            return None, None
+        book.advance(self.t)
+        views = book.clear()
+        self._views[stock] = self.t, views
+        return views
+
+    def quotes(self):
+        """ Returns a tuple of (stock, top bid, top ask) for every stock, with
+            the tops as (price, size) or None.
+        """
+        quotes = []
+        for stock in self.stocks:
+            bids, asks = self.clear(stock)
+            quotes.append((stock, bids and bids[0][:2] or None, asks and asks[0][:2] or None))
+        return tuple(quotes)
+
+
+class TapeExchange(object):
+    """ Stands in for an Exchange over a top of book tape, see
+        read_book_tape(), so that nothing is matched: adding a row of the
+        tape just makes its quotes the current ones.
+    """
+
+    def __init__(self):
+        self._quotes = ()
+        self.t = None
+
+    def add(self, t, quotes):
+        self._quotes = quotes
+        self.t = t
+
+    def replay(self, rows):
+        for t, quotes in rows:
+            self.add(t, quotes)
+            yield t
+
+    def quotes(self):
+        return self._quotes
+
+
 ################################################################################
 #
 # Test Data Persistence
 
-def generate_csv():
-    """ Generate a CSV of order history. """
-    with open('test.csv', 'wb') as f:
-        writer = csv.writer(f)
-        for t, stock, side, order, size in orders(market()):
-            if t > MARKET_OPEN + SIM_LENGTH:
+def generate_csv(path='test.csv', length=SIM_LENGTH, rows=None, seed=None, shards=1, t0=MARKET_OPEN):
+    """ Generate a CSV of order history covering `length` of sim time from
+        t0, stopping early after `rows` orders.  With shards > 1 the period is
+        split into that many consecutive slices, generated in parallel by a
+        process pool, each from its own seed derived from `seed`, and the
+        slices are joined in time order.  The same seed and shards give the
+        same file.
+    """
+    span = length / shards
+    if numpy is not None:
+        seeds = numpy.random.SeedSequence(seed).spawn(shards)
+    else:
+        seeds = [None if seed is None else '%s/%d' % (seed, i) for i in range(shards)]
+    jobs = []
+    for i in range(shards):
+        limit = None if rows is None else rows // shards + (i < rows % shards)
+        jobs.append(('%s.%d.part' % (path, i), t0 + span * i, span, limit, seeds[i]))
+    try:
+        if shards > 1:
+            with ProcessPoolExecutor(shards) as pool:
+                list(pool.map(write_orders, jobs))
+        else:
+            write_orders(jobs[0])
+        with open(path + '.tmp', 'wb') as out:
+            for job in jobs:
+                with open(job[0], 'rb') as f:
+                    shutil.copyfileobj(f, out, WRITE_BUFFER)
+        os.replace(path + '.tmp', path)
+    finally:
+        for job in jobs:
+            if os.path.exists(job[0]):
+                os.remove(job[0])
+
+
+def write_orders(job):
+    """ Writes one slice of generate_csv(), a tuple of (path, start, span,
+        rows, seed), in batches of BLOCK orders.
+    """
+    path, start, span, rows, seed = job
+    end = start + span
+    with open(path, 'w', newline='', buffering=WRITE_BUFFER) as f:
+        if numpy is None:
+            random_seed(seed)
+            writer = csv.writer(f)
+            batch = []
+            for n, order in enumerate(orders(market(start))):
+                if order[0] > end or n == rows:
+                    break
+                batch.append(order)
+                if len(batch) == BLOCK:
+                    writer.writerows(batch)
+                    batch = []
+            writer.writerows(batch)
+            return
+        end = numpy.datetime64(end, 'us')
+        stocks = numpy.array(STOCKS, dtype=object)
+        sides = numpy.array(SIDES, dtype=object)
+        block = BLOCK if rows is None else max(1, min(BLOCK, rows))
+        for t, stock, side, price, size in order_blocks(seed, start, block):
+            count = numpy.searchsorted(t, end, side='right')
+            if rows is not None:
+                count = min(count, rows)
+                rows -= count
+            times = numpy.datetime_as_string(t[:count], unit='us').tolist()
+            columns = ([s.replace('T', ' ') for s in times], stocks[stock[:count]].tolist(),
+                       sides[side[:count]].tolist(), map(repr, price[:count].tolist()),
+                       map(str, size[:count].tolist()))
+            f.writelines('%s,%s,%s,%s,%s\n' % row for row in zip(*columns))
+            if count < len(t) or rows == 0:
                 break
-            writer.writerow([t, stock, side, order, size])
 
 
-def read_csv():
-    """ Read a CSV or order history into a list. """
-    with open('test.csv', 'rt') as f:
-        for time, stock, side, order, size in csv.reader(f):
-            yield dateutil.parser.parse(time), stock, side, float(order), int(size)
+def parse_time(time):
+    """ Parse a timestamp from the order history.  The tapes are written as
+        YYYY-MM-DD HH:MM:SS.ffffff, which fromisoformat() reads directly;
+        anything else falls back to dateutil.
+    """
+    try:
+        return datetime.fromisoformat(time)
+    except ValueError:
+        return dateutil.parser.parse(time)
+
+
+def read_text_csv(path='test.csv'):
+    """ Read a CSV of order history from its text. """
+    with open(path, 'rt', buffering=READ_AHEAD) as f:
+        for stamp, stock, side, order, size in csv.reader(f):
+            yield parse_time(stamp), stock, side, float(order), int(size)
+
+
+def read_csv(path='test.csv', cache=True, start=0):
+    """ Read a CSV or order history into a list.  With cache, the first read
+        writes a binary column cache next to the CSV and later reads use it
+        instead of parsing the text.  Either way the history is streamed
+        through a fixed read-ahead buffer, so memory use doesn't depend on
+        its length.  The first `start` orders are skipped, by seeking in
+        the cache.
+    """
+    if cache:
+        tape = open_tape(path)
+        if tape is None and write_tape(path):
+            tape = open_tape(path)
+        if tape is not None:
+            return read_tape(tape, start)
+    return islice(read_text_csv(path), start, None)
+
+
+# The binary cache is a header, the stock names, then one column per field:
+# time (epoch ns), price, size, stock id and side, widest first so every
+# column stays aligned.
+
+TAPE_MAGIC = b'ORDTAPE1'
+TAPE_HEADER = struct.Struct('<8sQqQ32sI4x')  # magic, rows, csv mtime_ns, csv size, csv sha256, names length
+TAPE_COLUMNS = 'qdIHB'
+TAPE_CHUNK = 1 << 16  # rows read ahead from the binary cache
+READ_AHEAD = 1 << 20  # bytes read ahead from the CSV text
+WRITE_BUFFER = 1 << 20  # bytes buffered when writing a CSV
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+SIDES = ('buy', 'sell')
+
+
+def tape_path(path):
+    return path + '.bin'
+
+
+def file_digest(path):
+    """ Returns the sha256 of a file. """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def write_tape(path):
+    """ Parse a CSV of order history into its binary cache.  Columns are
+        spilled to scratch files a chunk at a time, so memory use doesn't
+        grow with the file.  Returns False if the history can't be cached.
+    """
+    stat = os.stat(path)
+    stocks = {}
+    rows = 0
+    try:
+        with ColumnFiles() as files:
+            columns = [files.column(code) for code in TAPE_COLUMNS]
+            try:
+                for t, stock, side, order, size in read_text_csv(path):
+                    stock_id = stocks.setdefault(stock, len(stocks))
+                    for column, value in zip(columns, (to_ns(t), order, size, stock_id, SIDES.index(side))):
+                        column.append(value)
+                    rows += 1
+                    if rows % TAPE_CHUNK == 0:
+                        files.spill()
+            except (TypeError, ValueError, OverflowError):
+                return False
+            names = '\n'.join(stocks).encode('utf-8')
+            names += b'\0' * (-len(names) % 8)
+            header = pack_header(path, stat, TAPE_HEADER, TAPE_MAGIC, rows, len(names))
+            files.write(tape_path(path), header + names, columns)
+        return True
+    except OSError:
+        return False
+
+
+class ColumnFiles(object):
+    """ The columns of a binary file being written from a CSV.  Each is an
+        array that spill() empties into a scratch file of its own, so memory
+        use doesn't grow with the file, and write() puts the file together.
+    """
+
+    def __init__(self):
+        self._files = {}
+
+    def column(self, code):
+        """ A new empty column of array type `code`. """
+        column = array(code)
+        self._files[id(column)] = column, tempfile.TemporaryFile()
+        return column
+
+    def spill(self):
+        for column, f in self._files.values():
+            column.tofile(f)
+            del column[:]
+
+    def write(self, path, head, columns):
+        """ Writes head and then the columns, in that order, to a scratch
+            file that then replaces path in one go.
+        """
+        scratch = path + '.tmp'
+        with open(scratch, 'wb') as out:
+            out.write(head)
+            for column in columns:
+                f = self._files[id(column)][1]
+                column.tofile(f)
+                del column[:]
+                f.seek(0)
+                shutil.copyfileobj(f, out)
+        os.replace(scratch, path)
+
+    def close(self):
+        for _, f in self._files.values():
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def pack_header(path, stat, header, magic, rows, *fields):
+    """ The header read_header() checks: the magic, rows, and the mtime and
+        size of the CSV as of `stat`, and its sha256, then the fields.
+    """
+    return header.pack(magic, rows, stat.st_mtime_ns, stat.st_size, file_digest(path), *fields)
+
+
+def read_header(path, f, header, magic):
+    """ Reads the header of a binary file built from a CSV, one that starts
+        with its magic, rows, and the mtime, size and sha256 of the CSV, or
+        returns None if the file is stale.  A file whose CSV was touched
+        without changing is kept, and its recorded mtime updated.
+    """
+    stat = os.stat(path)
+    data = f.read(header.size)
+    if len(data) < header.size:
+        return
+    fields = header.unpack(data)
+    if fields[0] != magic or fields[3] != stat.st_size:
+        return
+    if fields[2] != stat.st_mtime_ns:
+        if file_digest(path) != fields[4]:
+            return
+        fields = fields[:2] + (stat.st_mtime_ns,) + fields[3:]
+        f.seek(0)
+        f.write(header.pack(*fields))
+    return fields
+
+
+def open_tape(path):
+    """ Returns the header of the binary cache of a CSV, or None if it is
+        missing or stale.
+    """
+    try:
+        with open(tape_path(path), 'r+b') as f:
+            header = read_header(path, f, TAPE_HEADER, TAPE_MAGIC)
+            if header is None:
+                return
+            _, rows, _, _, _, names = header
+            stocks = f.read(names).rstrip(b'\0').decode('utf-8').split('\n')
+    except OSError:
+        return
+    return tape_path(path), rows, stocks, TAPE_HEADER.size + names
+
+
+def read_tape(tape, start=0):
+    """ Generates the orders of a binary cache from row `start`, reading
+        TAPE_CHUNK rows of every column at a time.
+    """
+    path, rows, stocks, offset = tape
+    starts = []
+    for code in TAPE_COLUMNS:
+        starts.append(offset)
+        offset += struct.calcsize(code) * rows
+    with open(path, 'rb') as f:
+        for first in range(start, rows, TAPE_CHUNK):
+            count = min(TAPE_CHUNK, rows - first)
+            columns = []
+            for code, start in zip(TAPE_COLUMNS, starts):
+                column = array(code)
+                f.seek(start + first * column.itemsize)
+                column.fromfile(f, count)
+                columns.append(column)
+            for ns, order, size, stock, side in zip(*columns):
+                yield from_ns(ns), stocks[stock], SIDES[side], order, size
+
+
+def read_book(path='test.csv'):
+    """ Generates the (t, quotes) after every order of a CSV, like a
+        TapeExchange takes them, from its top of book tape, built first if
+        it is missing or stale.  Falls back on matching the orders if the
+        tape can't be written.
+    """
+    tape = open_book_tape(path)
+    if tape is None and write_book_tape(path):
+        tape = open_book_tape(path)
+    if tape is not None:
+        return read_book_tape(tape)
+    return match_book(read_csv(path))
+
+
+def match_book(orders):
+    exchange = Exchange()
+    for t in exchange.replay(orders):
+        yield t, exchange.quotes()
+
+
+# The top of book tape is a header, the stock names in order, the row at
+# which each stock first traded, then columns of the time and, for every
+# stock from its first row on, the price and size of its best bid and ask,
+# with a NaN price for a side with no orders, as sizes can be 0.  Doubles come
+# before sizes, so every column stays aligned.
+
+BOOK_MAGIC = b'TOPTAPE1'
+BOOK_HEADER = struct.Struct('<8sQqQ32sII')  # magic, rows, csv mtime_ns, csv size, csv sha256, names length, stocks
+NO_QUOTE = (float('nan'), 0)
+
+
+def book_tape_path(path):
+    return path + '.tob'
+
+
+def write_book_tape(path='test.csv'):
+    """ Runs the order history of a CSV through an Exchange once and writes
+        the top of the book after every order to a binary tape next to it,
+        for the server to replay with REPLAY set.  Columns are spilled to
+        scratch files a chunk at a time, as write_tape() does.  Returns
+        False if the tape can't be written.
+    """
+    stat = os.stat(path)
+    books = {}  # stock -> first row, columns
+    rows = 0
+    try:
+        with ColumnFiles() as files:
+            times = files.column('q')
+            try:
+                for t, quotes in match_book(read_csv(path)):
+                    times.append(to_ns(t))
+                    for stock, bid, ask in quotes:
+                        book = books.get(stock)
+                        if book is None:
+                            book = books[stock] = rows, [files.column(code) for code in 'ddII']
+                        bid, ask = bid or NO_QUOTE, ask or NO_QUOTE
+                        for column, value in zip(book[1], (bid[0], ask[0], bid[1], ask[1])):
+                            column.append(value)
+                    rows += 1
+                    if rows % TAPE_CHUNK == 0:
+                        files.spill()
+            except (TypeError, ValueError, OverflowError):
+                return False
+            stocks = sorted(books)
+            names = '\n'.join(stocks).encode('utf-8')
+            names += b'\0' * (-len(names) % 8)
+            names += array('Q', [books[stock][0] for stock in stocks]).tobytes()
+            header = pack_header(path, stat, BOOK_HEADER, BOOK_MAGIC, rows, len(names), len(stocks))
+            columns = [times]
+            for first in (0, 2):
+                for stock in stocks:
+                    columns += books[stock][1][first:first + 2]
+            files.write(book_tape_path(path), header + names, columns)
+        return True
+    except OSError:
+        return False
+
+
+def open_book_tape(path):
+    """ Returns the header of the top of book tape of a CSV, or None if it
+        is missing or stale.
+    """
+    try:
+        with open(book_tape_path(path), 'r+b') as f:
+            header = read_header(path, f, BOOK_HEADER, BOOK_MAGIC)
+            if header is None:
+                return
+            _, rows, _, _, _, names, count = header
+            names = f.read(names)
+    except OSError:
+        return
+    firsts = array('Q')
+    firsts.frombytes(names[-8 * count:] if count else b'')
+    stocks = names[:-8 * count or None].rstrip(b'\0').decode('utf-8').split('\n') if count else []
+    return book_tape_path(path), rows, list(zip(stocks, firsts)), BOOK_HEADER.size + len(names)
+
+
+def read_book_tape(tape):
+    """ Generates the (t, quotes) of every row of a top of book tape, with
+        quotes as Exchange.quotes() returns them, read from a BookFile.
+    """
+    snapshots = BookFile(tape).snapshots
+    for row in range(len(snapshots)):
+        yield snapshots[row]
+
+
+def book_quote(price, size):
+    return None if math.isnan(price) else (price, size)
+
+
+class Column(object):
+    """ A read only sequence of get(i) for i below `length`, worked out
+        whenever it is read, that bisect can search and slices give lists.
+    """
+
+    def __init__(self, length, get):
+        self._length = length
+        self._get = get
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._get(j) for j in range(*i.indices(self._length))]
+        if i < 0:
+            i += self._length
+        if not 0 <= i < self._length:
+            raise IndexError(i)
+        return self._get(i)
+
+
+class BookFile(object):
+    """ A top of book tape, see open_book_tape(), mapped into memory and
+        read a row at a time, so that its columns are paged in and out by
+        the OS instead of held as objects.  `times` and `snapshots` are the
+        Columns of the time and Snapshot of every row.
+    """
+
+    def __init__(self, tape):
+        path, rows, stocks, offset = tape
+        with open(path, 'rb') as f:
+            view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        self._times = view[offset:offset + 8 * rows].cast('q')
+        offset += 8 * rows
+        columns = []
+        for width, code in ((8, 'd'), (4, 'I')):
+            for stock, first in stocks:
+                for _ in 'ba':
+                    columns.append(view[offset:offset + width * (rows - first)].cast(code))
+                    offset += width * (rows - first)
+        count = len(stocks)
+        self.books = [(stock, first, columns[2 * i:2 * i + 2] + columns[2 * (count + i):2 * (count + i) + 2])
+                      for i, (stock, first) in enumerate(stocks)]
+        self.times = Column(rows, self.time)
+        self.snapshots = Column(rows, self.snapshot)
+
+    def time(self, row):
+        return from_ns(self._times[row])
+
+    def snapshot(self, row):
+        quotes = []
+        for stock, first, (bid_prices, ask_prices, bid_sizes, ask_sizes) in self.books:
+            if row >= first:
+                i = row - first
+                quotes.append((stock, book_quote(bid_prices[i], bid_sizes[i]), book_quote(ask_prices[i], ask_sizes[i])))
+        return Snapshot(self.time(row), tuple(quotes))
+
+    def quotes(self, stock):
+        """ Generates the (t, bid, ask) of a stock at every row from its
+            first, reading just its own columns.
+        """
+        for name, first, (bid_prices, ask_prices, bid_sizes, ask_sizes) in self.books:
+            if name == stock:
+                for i, row in enumerate(range(first, len(self.times))):
+                    yield self.time(row), book_quote(bid_prices[i], bid_sizes[i]), book_quote(ask_prices[i], ask_sizes[i])
+
+
+# A checkpoint is a header, then for every book its stock name and, for
+# each of its sides, the side's clock and resting orders, oldest first.
+# Clocks and expiries are order counts, or epoch ns when the ttl is a
+# timedelta.
+
+CHECKPOINT_MAGIC = b'ENGCKPT1'
+CHECKPOINT_HEADER = struct.Struct('<8sQqQ32sqqI?3x')  # magic, rows, csv mtime_ns, csv size, csv sha256, t, ttl, books, ttl counts orders
+BOOK_STATE = struct.Struct('<HB')  # name length, sides
+SIDE_STATE = struct.Struct('<BqI')  # side, clock, orders
+ORDER_STATE = struct.Struct('<dIq')  # price, size, expiry
+
+
+def checkpoint_path(path):
+    return path + '.ckpt'
+
+
+class Checkpoint(object):
+    """ The state of an Engine's Exchange and how many orders of its CSV it
+        has taken, saved every `every` orders to a file next to the CSV, so
+        that a restarted engine carries on from there instead of matching
+        the history again from the start.
+    """
+
+    def __init__(self, path='test.csv', every=CHECKPOINT_EVERY):
+        self.path = path
+        self.every = every
+        self._source = None
+
+    def _stat(self):
+        """ The mtime, size and sha256 of the CSV, hashed once. """
+        if self._source is None:
+            stat = os.stat(self.path)
+            self._source = stat.st_mtime_ns, stat.st_size, file_digest(self.path)
+        return self._source
+
+    def save(self, exchange, rows):
+        """ Replaces the last checkpoint with the state of an exchange that
+            has taken `rows` orders.  Returns False if it can't be written.
+        """
+        ttl, t, books = exchange.state()
+        counted = not isinstance(ttl, timedelta)
+        clock = int if counted else to_ns
+        try:
+            mtime, size, digest = self._stat()
+            parts = [CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, rows, mtime, size, digest, to_ns(t),
+                                            ttl if counted else ttl // MICROSECOND * 1000, len(books), counted)]
+            for stock, sides in books.items():
+                name = stock.encode('utf-8')
+                parts.append(BOOK_STATE.pack(len(name), len(sides)) + name)
+                for side, (now, orders) in sides.items():
+                    parts.append(SIDE_STATE.pack(SIDES.index(side), clock(now), len(orders)))
+                    parts.extend(ORDER_STATE.pack(order, size, clock(expiry)) for order, size, expiry in orders)
+            scratch = checkpoint_path(self.path) + '.tmp'
+            with open(scratch, 'wb') as f:
+                f.write(b''.join(parts))
+            os.replace(scratch, checkpoint_path(self.path))
+            return True
+        except OSError:
+            return False
+
+    def load(self, ttl=ORDER_TTL):
+        """ Returns the Exchange of the last checkpoint and the orders it
+            had taken, or None if there is none, or it was saved with
+            another ttl or from another CSV.
+        """
+        try:
+            with open(checkpoint_path(self.path), 'r+b') as f:
+                header = read_header(self.path, f, CHECKPOINT_HEADER, CHECKPOINT_MAGIC)
+                if header is None:
+                    return
+                data = f.read()
+        except OSError:
+            return
+        _, rows, _, _, _, t, saved_ttl, count, counted = header
+        if counted != (not isinstance(ttl, timedelta)):
+            return
+        clock = int if counted else from_ns
+        if saved_ttl != (ttl if counted else ttl // MICROSECOND * 1000):
+            return
+        books, offset = {}, 0
+        try:
+            for _ in range(count):
+                length, count_sides = BOOK_STATE.unpack_from(data, offset)
+                offset += BOOK_STATE.size
+                sides = books[data[offset:offset + length].decode('utf-8')] = {}
+                offset += length
+                for _ in range(count_sides):
+                    side, now, count_orders = SIDE_STATE.unpack_from(data, offset)
+                    offset += SIDE_STATE.size
+                    end = offset + count_orders * ORDER_STATE.size
+                    if end > len(data):
+                        return
+                    sides[SIDES[side]] = clock(now), [(order, size, clock(expiry)) for order, size, expiry
+                                                      in ORDER_STATE.iter_unpack(data[offset:end])]
+                    offset = end
+        except (struct.error, IndexError, UnicodeDecodeError):
+            return
+        return Exchange.restore(ttl, from_ns(t), books), rows
+
+
+def to_ns(t):
+    return (t - EPOCH) // MICROSECOND * 1000
+
+
+def from_ns(ns):
+    return EPOCH + MICROSECOND * (ns // 1000)
+
+
+################################################################################
+#
+# Engine
+
+Snapshot = namedtuple('Snapshot', 't quotes')
+
+
+class SimClock(object):
+    """ Sim time that runs `speed` times faster than a monotonic clock,
+        starting from `start`.
+    """
+
+    def __init__(self, start, speed=SIM_SPEED):
+        self.start = start
+        self.speed = speed
+        self._rt_start = time.monotonic()
+
+    def now(self):
+        return self.start + timedelta(seconds=(time.monotonic() - self._rt_start) * self.speed)
+
+    def until(self, t):
+        """ Returns the real seconds left until sim time t. """
+        return (t - self.now()).total_seconds() / self.speed
+
+
+class BookTape(object):
+    """ The top of the book after every order of an order history, shared,
+        read only, by every Session replaying it.  With `path` it is the
+        BookFile of that CSV's top of book tape, built first if it is
+        missing or stale, so that the rows are read from disk as sessions
+        reach them.  Otherwise, or if the tape can't be written, the orders
+        are matched once when first needed and every Snapshot kept in
+        memory.  `exchange` makes what the orders are added to, eg. a
+        TapeExchange for the rows of read_book().
+    """
+
+    def __init__(self, orders, warmup=10, exchange=Exchange, path=None):
+        self._orders = orders
+        self._exchange = exchange
+        self._path = path
+        self._lock = threading.Lock()
+        self.warmup = warmup
+        self.times = None
+        self.snapshots = None
+        self.stocks = None
+        self._book = None
+        self._histories = {}
+
+    def load(self):
+        """ Maps the tape or matches the orders unless that has been done,
+            and returns self.
+        """
+        if self.snapshots is None:
+            with self._lock:
+                if self.snapshots is None:
+                    tape = self._path and open_book_tape(self._path)
+                    if self._path and tape is None and write_book_tape(self._path):
+                        tape = open_book_tape(self._path)
+                    if tape:
+                        self._book = BookFile(tape)
+                        self.stocks = frozenset(stock for stock, _, _ in self._book.books)
+                        self.times = self._book.times
+                        self.snapshots = self._book.snapshots
+                    else:
+                        exchange = self._exchange()
+                        times, snapshots = [], []
+                        for t in exchange.replay(self._orders()):
+                            times.append(t)
+                            snapshots.append(Snapshot(t, exchange.quotes()))
+                        self.stocks = frozenset(name for name, _, _ in snapshots[-1].quotes) if snapshots else frozenset()
+                        self.times = times
+                        self.snapshots = snapshots
+        return self
+
+    def history(self, stock):
+        """ The times at which the top of the book of a stock changed, and
+            its (bid, ask) from then on, indexed once per stock when first
+            needed.  Both are empty for a stock that never traded, which is
+            not indexed, so that asking for made up stocks costs nothing.
+        """
+        history = self._histories.get(stock)
+        if history is None:
+            if stock not in self.load().stocks:
+                return (), ()
+            with self._lock:
+                history = self._histories.get(stock)
+                if history is None:
+                    if self._book is not None:
+                        rows = self._book.quotes(stock)
+                    else:
+                        rows = ((t, bid, ask) for t, snapshot in self.snapshots
+                                for name, bid, ask in snapshot if name == stock)
+                    times, quotes, last = [], [], None
+                    for t, bid, ask in rows:
+                        if (bid, ask) != last:
+                            last = bid, ask
+                            times.append(t)
+                            quotes.append(last)
+                    history = self._histories[stock] = times, quotes
+        return history
+
+    def seek(self, at):
+        """ The Snapshot of the books once every order up to sim time `at`
+            has been added, found by binary search on time, or None if there
+            were none by then.
+        """
+        self.load()
+        i = bisect.bisect_right(self.times, at) - 1
+        return self.snapshots[i] if i >= 0 else None
+
+
+class Session(object):
+    """ A client's own cursor over a loaded BookTape.  It starts where the
+        Engine publishes its first snapshot, and then either steps one order
+        per query, if speed is None, or follows its own sim clock running
+        `speed` times faster than real time.  Like the Engine it starts over
+        at the end of the tape.
+    """
+
+    def __init__(self, tape, speed=None):
+        self._tape = tape
+        self._lock = threading.Lock()
+        self._index = max(min(tape.warmup, len(tape.snapshots) - 1), 0)
+        self.speed = None
+        self._clock = None
+        self.set_speed(speed)
+
+    def set_speed(self, speed):
+        """ Changes the speed, carrying on from the current snapshot. """
+        with self._lock:
+            self.speed = speed
+            self._clock = speed and SimClock(self._tape.times[self._index], speed)
+
+    def next(self, after=None, timeout=0):
+        """ The snapshot for this session's next query.  On a sim clock,
+            with `after`, waits up to timeout seconds for a snapshot past
+            that sim time, or for the tape to start over.
+        """
+        return self.batch(1, after, timeout)[-1]
+
+    def batch(self, n, after=None, timeout=0):
+        """ Up to n snapshots for this session's next query, waiting like
+            next() with `after`: the next n steps, or on a sim clock the
+            latest n book changes since the previous query, or the current
+            snapshot if there are none.
+        """
+        poll = self.poll(n, after)
+        deadline = time.monotonic() + timeout
+        while True:
+            left = deadline - time.monotonic()
+            snapshots = poll(left <= 0)
+            if isinstance(snapshots, list):
+                return snapshots
+            time.sleep(min(snapshots, left))
+
+    def poll(self, n, after=None):
+        """ batch() as a function for a LongPoll, that moves the session on
+            each time it is called and returns its snapshots, or, until it
+            is called with last set, the seconds until there may be one past
+            `after`.
+        """
+        times = self._tape.times
+        previous = None
+
+        def poll(last=False):
+            nonlocal previous
+            index, snapshots = self._advance(n)
+            wrapped = previous is not None and index < previous
+            previous = index
+            if after is None:
+                return snapshots
+            clock = self._clock
+            if snapshots[-1].t <= after and clock is not None and not (last or wrapped):
+                due = times[min(bisect.bisect_right(times, after), len(times) - 1)]
+                return max(clock.until(due), 0.001)
+            return [s for s in snapshots if s.t > after] or snapshots[-1:]
+
+        return poll
+
+    def _advance(self, n):
+        tape = self._tape
+        with self._lock:
+            if self.speed is None:
+                indices = []
+                for _ in range(n):
+                    self._index += 1
+                    if self._index >= len(tape.snapshots):
+                        self._index = min(tape.warmup + 1, len(tape.snapshots) - 1)
+                    indices.append(self._index)
+                return self._index, [tape.snapshots[i] for i in indices]
+            last = self._index
+            now = self._clock.now()
+            if now > tape.times[-1]:
+                self._index = min(tape.warmup, len(tape.snapshots) - 1)
+                self._clock = SimClock(tape.times[self._index], self.speed)
+            else:
+                self._index = bisect.bisect_right(tape.times, now, self._index) - 1
+            if self._index <= last:
+                return self._index, tape.snapshots[self._index:self._index + 1]
+            return self._index, tape.snapshots[max(last + 1, self._index + 1 - n):self._index + 1]
+
+
+class EngineError(Exception):
+    """ Raised to callers of an Engine whose thread has died, with the
+        error that killed it as the cause.
+    """
+
+
+class Engine(object):
+    """ Replays a tape through an Exchange on its own thread, the only one
+        that ever touches the books, and publishes an immutable Snapshot of
+        the top of every book for any number of readers.  The tape is
+        replayed again from the start when it runs out.
+
+        With a speed, each order is added once a SimClock running that many
+        times real time reaches it, and a snapshot is published whenever the
+        engine catches up with the clock; readers just take the latest one
+        and never wait for matching.  With speed None the engine steps one
+        order for every call to step().  Like a BookTape, it adds the orders
+        to what `exchange` makes.
+
+        With a Checkpoint the engine saves its books every so many orders
+        and when it is stopped, and starts from the last checkpoint, taking
+        the orders from there with orders(start=rows).
+
+        An error raised by the orders stops the engine; it is kept as
+        `error`, and start(), step(), wait() and check() raise it, as an
+        EngineError.
+    """
+
+    def __init__(self, orders, speed=SIM_SPEED, warmup=10, exchange=Exchange, checkpoint=None):
+        self._orders = orders
+        self._exchange = exchange
+        self._checkpoint = checkpoint
+        self._speed = speed
+        self._warmup = warmup
+        self._changed = threading.Condition()
+        self._wanted = 0
+        self._steps = 0
+        self._stepped = {}
+        self._ready = threading.Event()
+        self._stopped = threading.Event()
+        self._subscribers = ()
+        self._replays = 0
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self.snapshot = None
+        self.error = None
+
+    def start(self):
+        """ Starts the engine, returning once the first snapshot is out. """
+        self._thread.start()
+        self._ready.wait()
+        self.check()
+        return self
+
+    def check(self):
+        """ Raises an EngineError if the engine thread has died. """
+        if self.error is not None:
+            raise EngineError('the engine has stopped: %s' % self.error) from self.error
+
+    def stop(self):
+        with self._changed:
+            self._stopped.set()
+            self._changed.notify_all()
+        self._thread.join()
+
+    @property
+    def stepped(self):
+        return self._speed is None
+
+    def step(self):
+        """ Has the engine add the next order, and returns the snapshot it
+            published for it.  Concurrent callers each get their own order.
+        """
+        return self.steps(1)[0]
+
+    def steps(self, n):
+        """ Has the engine add the next n orders, and returns the snapshots
+            it published for them, in one round trip to the engine thread.
+        """
+        with self._changed:
+            first = self._wanted + 1
+            self._wanted += n
+            wanted = self._wanted
+            self._changed.notify_all()
+            while wanted not in self._stepped and not self._stopped.is_set():
+                self._changed.wait()
+            if wanted not in self._stepped:
+                self.check()
+            return [self._stepped.pop(step, self.snapshot) for step in range(first, wanted + 1)]
+
+    def wait(self, after, timeout):
+        """ Waits up to timeout seconds for a snapshot past sim time `after`,
+            or for the tape to start over, and returns the latest snapshot.
+        """
+        with self._changed:
+            replays = self._replays
+            self._changed.wait_for(lambda: self._moved(after, replays), timeout)
+            self.check()
+            return self.snapshot
+
+    def poll(self, after):
+        """ wait() as a function for a LongPoll subscribed to the engine,
+            that returns [the latest snapshot] once wait() would, or when
+            called with last set, and None until then.
+        """
+        replays = self._replays
+
+        def poll(last=False):
+            self.check()
+            if last or self._moved(after, replays):
+                return [self.snapshot]
+
+        return poll
+
+    def _moved(self, after, replays):
+        return self.snapshot.t > after or self._replays != replays or self._stopped.is_set()
+
+    def subscribe(self, callback):
+        """ Calls callback with every snapshot published from now on, on the
+            engine thread, so it must not block.  Returns a function that
+            unsubscribes it.
+        """
+        with self._changed:
+            self._subscribers += (callback,)
+
+        def unsubscribe():
+            with self._changed:
+                self._subscribers = tuple(s for s in self._subscribers if s is not callback)
+
+        return unsubscribe
+
+    def _publish(self, exchange, step=None):
+        with self._changed:
+            self.snapshot = snapshot = Snapshot(exchange.t, exchange.quotes())
+            if step is not None:
+                self._stepped[step] = snapshot
+            self._changed.notify_all()
+        for callback in self._subscribers:
+            callback(snapshot)
+        self._ready.set()
+
+    def _wait_for_step(self):
+        """ Waits for a caller of step(), returning the step number, or None
+            if the engine was stopped.
+        """
+        with self._changed:
+            while self._steps >= self._wanted:
+                if self._stopped.is_set():
+                    return
+                self._changed.wait()
+            self._steps += 1
+            return self._steps
+
+    def _added(self, exchange, rows):
+        checkpoint = self._checkpoint
+        if checkpoint is not None and checkpoint.every and rows % checkpoint.every == 0:
+            checkpoint.save(exchange, rows)
+
+    def _save(self, exchange, rows):
+        if self._checkpoint is not None:
+            self._checkpoint.save(exchange, rows)
+
+    def _run(self):
+        try:
+            self._replay()
+        except Exception as e:
+            traceback.print_exc()
+            self.error = e
+        finally:
+            with self._changed:
+                self._stopped.set()
+                self._changed.notify_all()
+            self._ready.set()
+
+    def _replay(self):
+        resume = self._checkpoint and self._checkpoint.load()
+        while not self._stopped.is_set():
+            if resume:
+                exchange, rows = resume
+                orders = iter(self._orders(start=rows))
+                resume = None
+            else:
+                exchange = self._exchange()
+                orders = iter(self._orders())
+                rows = 0
+                for order in islice(orders, self._warmup + 1):
+                    exchange.add(*order)
+                    rows += 1
+                if exchange.t is None:
+                    raise ValueError('no orders to replay')
+            clock = SimClock(exchange.t, self._speed or 1)
+            self._replays += 1
+            self._publish(exchange)
+            for order in orders:
+                if self.stepped:
+                    step = self._wait_for_step()
+                    if step is None:
+                        return self._save(exchange, rows)
+                    exchange.add(*order)
+                    rows += 1
+                    self._added(exchange, rows)
+                    self._publish(exchange, step)
+                    continue
+                delay = clock.until(order[0])
+                if delay > 0:
+                    self._publish(exchange)
+                    if self._stopped.wait(delay):
+                        return self._save(exchange, rows)
+                exchange.add(*order)
+                rows += 1
+                self._added(exchange, rows)
+            self._publish(exchange)
 
 
 ################################################################################
@@ -239,73 +1787,888 @@ class ThreadedHTTPServer(ThreadingMixIn, http.server.HTTPServer):
         shutdown.
     """
     allow_reuse_address = True
+    keep_alive = KEEP_ALIVE
+
+    def __init__(self, address, handler):
+        http.server.HTTPServer.__init__(self, address, handler)
+        self.streams = set()
 
     def shutdown(self):
         """ Override MRO to shutdown properly. """
         self.socket.close()
         http.server.HTTPServer.shutdown(self)
 
+    def server_close(self):
+        for events in list(self.streams):
+            events.close()
+        ThreadingMixIn.server_close(self)
+
+    def busy(self):
+        return False
 
-def route(path):
+    def add_stream(self, events):
+        self.streams.add(events)
+        return True
+
+
+class PooledHTTPServer(http.server.HTTPServer):
+    """ HTTP server that hands connections to a fixed pool of worker threads
+        through a bounded queue.  When the queue is full a connection is
+        answered 503 straight away and closed, so a burst of clients can't
+        pile up threads or slow down the ones already being served.  An event
+        stream or LongPoll holds on to its worker for as long as it is open,
+        so at most `streams` of them, and always fewer than the workers, are
+        let in and the rest are answered 503 too.
+    """
+    allow_reuse_address = True
+    keep_alive = POOL_KEEP_ALIVE
+
+    def __init__(self, address, handler, workers=WORKERS, queue_size=QUEUE_SIZE, streams=STREAMS):
+        self.request_queue_size = queue_size
+        http.server.HTTPServer.__init__(self, address, handler)
+        self.streams = set()
+        self.max_streams = min(streams, workers - 1)
+        self._streams_lock = threading.Lock()
+        self._connections = queue.Queue(queue_size)
+        self._workers = [threading.Thread(target=self._work) for _ in range(workers)]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+    def process_request(self, request, client_address):
+        try:
+            self._connections.put_nowait((request, client_address))
+        except queue.Full:
+            self.reject(request)
+            self.shutdown_request(request)
+
+    def busy(self):
+        """ Whether connections are waiting for a worker, in which case kept
+            alive ones should be let go.
+        """
+        return not self._connections.empty()
+
+    def add_stream(self, events):
+        """ Takes on an event stream or LongPoll, unless that would leave
+            too few workers for other requests.
+        """
+        with self._streams_lock:
+            if len(self.streams) >= self.max_streams:
+                return False
+            self.streams.add(events)
+            return True
+
+    def reject(self, request):
+        """ Tells an overflowing client the server is overloaded. """
+        try:
+            request.sendall(OVERLOADED)
+        except OSError:
+            pass
+
+    def _work(self):
+        while True:
+            connection = self._connections.get()
+            if connection is None:
+                return
+            request, client_address = connection
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        http.server.HTTPServer.server_close(self)
+        for events in list(self.streams):
+            events.close()
+        for _ in self._workers:
+            self._connections.put(None)
+        for worker in self._workers:
+            worker.join()
+
+
+OVERLOADED_BODY = b'{"error": "server overloaded"}\n'
+OVERLOADED = (b'HTTP/1.0 503 Service Unavailable\r\n'
+              b'Content-Type: application/json\r\n'
+              b'Access-Control-Allow-Origin: *\r\n'
+              b'Retry-After: 1\r\n'
+              b'Connection: close\r\n'
+              b'Content-Length: %d\r\n\r\n' % len(OVERLOADED_BODY)) + OVERLOADED_BODY
+
+
+class EventStream(object):
+    """ Returned by a route to keep its connection open and push Server-Sent
+        Events.  subscribe(callback) has callback called with every new
+        value and returns a function that unsubscribes it.  Only the latest
+        value is kept until the client has been sent the previous one, so a
+        slow client skips values rather than building up a backlog.
+        render(value) turns a value into event bytes, or b'' when there is
+        nothing to send.
+    """
+    head = (b'HTTP/1.1 200 OK\r\n'
+            b'Content-Type: text/event-stream\r\n'
+            b'Cache-Control: no-cache\r\n'
+            b'Access-Control-Allow-Origin: *\r\n'
+            b'Connection: close\r\n\r\n')
+    PING = b': ping\n\n'
+
+    def __init__(self, subscribe, render, first=None, heartbeat=HEARTBEAT):
+        self._render = render
+        self._heartbeat = heartbeat
+        self._lock = threading.Lock()
+        self._value = first
+        self._pending = first is not None
+        self._outbox = []
+        self._last = False
+        self._closed = False
+        self._event = threading.Event()
+        self._wake = None
+        if self._pending:
+            self._event.set()
+        self._unsubscribe = subscribe(self._push)
+
+    def _push(self, value):
+        with self._lock:
+            self._value = value
+            self._pending = True
+            wake = self._wake
+        self._event.set()
+        if wake is not None:
+            wake()
+
+    def refresh(self):
+        """ Renders the latest value again, eg. after what render() sends
+            has changed.
+        """
+        if self._value is not None:
+            self._push(self._value)
+
+    def send(self, data, last=False):
+        """ Queues bytes to go out ahead of the next events, and ends the
+            stream once they are out if `last` is set.
+        """
+        with self._lock:
+            self._outbox.append(data)
+            self._last = self._last or last
+            wake = self._wake
+        self._event.set()
+        if wake is not None:
+            wake()
+
+    def _take(self):
+        with self._lock:
+            self._event.clear()
+            if self._closed:
+                raise EOFError
+            sent = b''.join(self._outbox)
+            del self._outbox[:]
+            if self._last:
+                self._closed = True
+                self._event.set()
+                return sent
+            if not self._pending:
+                return sent
+            self._pending = False
+            value = self._value
+        return sent + self._render(value)
+
+    def next(self):
+        """ Waits for the next events to send, or a ping once `heartbeat`
+            seconds go by without any.  Returns None once closed.
+        """
+        try:
+            while self._event.wait(self._heartbeat):
+                events = self._take()
+                if events:
+                    return events
+            return self._take() or self.PING
+        except EOFError:
+            return None
+
+    async def next_async(self):
+        """ next() for an asyncio event loop. """
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        self._wake = lambda: loop.call_soon_threadsafe(event.set)
+        try:
+            while True:
+                event.clear()
+                events = self._take()
+                if events:
+                    return events
+                try:
+                    await asyncio.wait_for(event.wait(), self._heartbeat)
+                except asyncio.TimeoutError:
+                    return self._take() or self.PING
+        except EOFError:
+            return None
+        finally:
+            self._wake = None
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            wake = self._wake
+        self._unsubscribe()
+        self._event.set()
+        if wake is not None:
+            wake()
+
+
+class LongPoll(object):
+    """ Returned by a route to answer once there is something new to say,
+        or after `timeout` seconds, without holding a thread for it on the
+        asyncio server.  check(last) returns the response body, or, until
+        called with last set, None to be checked again when the callback
+        of subscribe(callback) is called, or the seconds after which to
+        check again.  It may raise an HTTPError.
+    """
+
+    def __init__(self, check, timeout, subscribe=None):
+        self._check = check
+        self._timeout = timeout
+        self._closed = False
+        self._event = threading.Event()
+        self._wake = None
+        self._unsubscribe = subscribe(self._push) if subscribe is not None else None
+
+    def _push(self, value):
+        self._event.set()
+        wake = self._wake
+        if wake is not None:
+            wake()
+
+    def wait(self):
+        """ Waits for the response body, on a thread of its own. """
+        deadline = time.monotonic() + self._timeout
+        try:
+            while True:
+                self._event.clear()
+                left = deadline - time.monotonic()
+                data = self._check(left <= 0 or self._closed)
+                if isinstance(data, bytes):
+                    return data
+                self._event.wait(left if data is None else min(data, left))
+        finally:
+            self.close()
+
+    async def wait_async(self):
+        """ wait() for an asyncio event loop. """
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        self._wake = lambda: loop.call_soon_threadsafe(event.set)
+        deadline = loop.time() + self._timeout
+        try:
+            while True:
+                event.clear()
+                left = deadline - loop.time()
+                data = self._check(left <= 0 or self._closed)
+                if isinstance(data, bytes):
+                    return data
+                try:
+                    await asyncio.wait_for(event.wait(), left if data is None else min(data, left))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._wake = None
+            self.close()
+
+    def close(self):
+        """ Has the poll answer now, as if it had timed out. """
+        self._closed = True
+        if self._unsubscribe is not None:
+            self._unsubscribe()
+            self._unsubscribe = None
+        self._push(None)
+
+
+WEBSOCKET_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+WEBSOCKET_MAX_MESSAGE = 1 << 16  # longest message a client may send
+
+
+def websocket_frame(opcode, payload=b''):
+    """ An unmasked, unfragmented WebSocket frame, as a server sends them. """
+    length = len(payload)
+    if length < 126:
+        head = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 1 << 16:
+        head = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        head = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return head + payload
+
+
+def websocket_close(code):
+    return websocket_frame(0x8, struct.pack('!H', code))
+
+
+def unmask(payload, mask):
+    length = len(payload)
+    mask = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, 'big') ^ int.from_bytes(mask, 'big')).to_bytes(length, 'big')
+
+
+class WebSocket(EventStream):
+    """ An EventStream over a WebSocket, answering the handshake of the
+        request headers, or raising HTTPError if they don't ask for one.
+        render(value) returns the payload of a binary message, or b'' when
+        there is nothing to send, and a ping goes out after `heartbeat` idle
+        seconds.  The server feed()s whatever it reads from the client, and
+        every complete message, text ones decoded, is passed on to
+        receive(websocket, message).
+    """
+    PING = websocket_frame(0x9)
+
+    def __init__(self, headers, subscribe, render, receive, first=None, heartbeat=HEARTBEAT):
+        key = headers.get('sec-websocket-key')
+        if (headers.get('upgrade') or '').lower() != 'websocket' or not key:
+            raise HTTPError(400, 'expected a websocket upgrade')
+        if headers.get('sec-websocket-version') != '13':
+            raise HTTPError(400, 'unsupported websocket version')
+        accept = base64.b64encode(hashlib.sha1(key.strip().encode('latin-1') + WEBSOCKET_GUID).digest())
+        self.head = (b'HTTP/1.1 101 Switching Protocols\r\n'
+                     b'Upgrade: websocket\r\n'
+                     b'Connection: Upgrade\r\n'
+                     b'Sec-WebSocket-Accept: %s\r\n\r\n' % accept)
+        self._receive = receive
+        self._buffer = b''
+        self._fragments = None
+        EventStream.__init__(self, subscribe, lambda value: self._binary(render(value)), first, heartbeat)
+
+    @staticmethod
+    def _binary(payload):
+        return payload and websocket_frame(0x2, payload)
+
+    def feed(self, data):
+        """ Handles every complete frame read from the client so far, and
+            returns whether to carry on reading; not once the client has
+            closed the connection, or broken the protocol.
+        """
+        if not data:
+            self.close()
+            return False
+        self._buffer += data
+        while len(self._buffer) >= 2:
+            first, length = self._buffer[0], self._buffer[1] & 0x7f
+            opcode, offset = first & 0x0f, 2
+            if length >= 126:
+                offset = length == 126 and 4 or 10
+                if len(self._buffer) < offset:
+                    return True
+                length = int.from_bytes(self._buffer[2:offset], 'big')
+            if not self._buffer[1] & 0x80 or first & 0x70:
+                return self._fail(1002)
+            if length > WEBSOCKET_MAX_MESSAGE:
+                return self._fail(1009)
+            end = offset + 4 + length
+            if len(self._buffer) < end:
+                return True
+            payload = unmask(self._buffer[offset + 4:end], self._buffer[offset:offset + 4])
+            self._buffer = self._buffer[end:]
+            if not self._frame(first & 0x80, opcode, payload):
+                return False
+        return True
+
+    def _frame(self, fin, opcode, payload):
+        if opcode == 0x8:
+            self.send(websocket_frame(0x8, payload[:2]), last=True)
+            return False
+        if opcode == 0x9:
+            self.send(websocket_frame(0xA, payload))
+        elif opcode in (0x1, 0x2) and self._fragments is None:
+            self._fragments = opcode, [payload]
+        elif opcode == 0x0 and self._fragments is not None:
+            self._fragments[1].append(payload)
+            if sum(map(len, self._fragments[1])) > WEBSOCKET_MAX_MESSAGE:
+                return self._fail(1009)
+        elif opcode != 0xA:
+            return self._fail(1002)
+        if fin and opcode in (0x0, 0x1, 0x2):
+            opcode, fragments = self._fragments
+            self._fragments = None
+            message = b''.join(fragments)
+            if opcode == 0x1:
+                try:
+                    message = message.decode('utf-8')
+                except UnicodeDecodeError:
+                    return self._fail(1007)
+            self._receive(self, message)
+        return True
+
+    def _fail(self, code):
+        self.send(websocket_close(code), last=True)
+        return False
+
+
+class HTTPError(Exception):
+    """ Raised by a route to answer with an error status instead. """
+
+    def __init__(self, status, message=None):
+        Exception.__init__(self, message or http.HTTPStatus(status).phrase.lower())
+        self.status = status
+
+    def body(self):
+        return bytes(json.dumps({'error': str(self)}) + '\n', encoding='utf-8')
+
+
+def route(path, headers=False, blocking=None):
     """ Decorator for a simple bottle-like web framework.  Routes path to the
-        decorated method, with the rest of the path as an argument.
+        decorated method, with the rest of the path as an argument, and the
+        request headers too if `headers` is set.  The method returns data to
+        be encoded as JSON, bytes already encoded, or an EventStream.
+        `blocking` names the query parameter, or a tuple of them, with which
+        the method may wait a while before returning, or is True if it may
+        always do so.
     """
+    if isinstance(blocking, str):
+        blocking = (blocking,)
 
     def _route(f):
         setattr(f, '__route__', path)
+        setattr(f, '__headers__', headers)
+        setattr(f, '__blocking__', blocking or ())
         return f
 
     return _route
 
 
 def read_params(path):
-    """ Read query parameters into a dictionary if they are parseable,
-        otherwise returns None.
-    """
-    query = path.split('?')
-    if len(query) > 1:
-        query = query[1].split('&')
-        return dict(map(lambda x: x.split('='), query))
-
-
-def get(req_handler, routes):
-    """ Map a request to the appropriate route of a routes instance. """
-    for name, handler in routes.__class__.__dict__.items():
-        if hasattr(handler, "__route__"):
-            if None != re.search(handler.__route__, req_handler.path):
-                req_handler.send_response(200)
-                req_handler.send_header('Content-Type', 'application/json')
-                req_handler.send_header('Access-Control-Allow-Origin', '*')
-                req_handler.end_headers()
-                params = read_params(req_handler.path)
-                data = json.dumps(handler(routes, params)) + '\n'
-                req_handler.wfile.write(bytes(data, encoding='utf-8'))
-                return
+    """ Read query parameters into a dictionary, decoding them, or returns
+        None if there is no query string.
+    """
+    _, query, params = path.partition('?')
+    if query:
+        return dict(parse_qsl(params, keep_blank_values=True))
 
 
-def run(routes, host='0.0.0.0', port=8080):
-    """ Runs a class as a server whose methods have been decorated with
-        @route.
+ROUTE_PATTERN = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+
+class Router(object):
+    """ The routes of a class whose methods have been decorated with @route,
+        compiled once.  Routes with a plain path are looked up in a dict by
+        the path of a request, the rest are regular expressions searched for
+        in it, in the order they were defined.
     """
 
+    def __init__(self, routes):
+        self.routes = routes
+        self.paths = {}
+        self.patterns = []
+        for name, handler in routes.__class__.__dict__.items():
+            if hasattr(handler, "__route__"):
+                handler = getattr(routes, name)
+                if ROUTE_PATTERN.search(handler.__route__):
+                    self.patterns.append((re.compile(handler.__route__), handler))
+                else:
+                    self.paths.setdefault(handler.__route__, handler)
+
+    def find(self, path):
+        """ The route for the path of a request, or None. """
+        handler = self.paths.get(path)
+        if handler is None:
+            for pattern, route in self.patterns:
+                if pattern.search(path):
+                    return route
+        return handler
+
+    def blocks(self, path):
+        """ Whether the route for the path of a request may wait before it
+            returns, going by the parameters of the request.
+        """
+        handler = self.find(path.partition('?')[0])
+        blocking = getattr(handler, '__blocking__', ())
+        if blocking is True:
+            return True
+        params = read_params(path) or ()
+        return any(name in params for name in blocking)
+
+    def dispatch(self, path, headers=None):
+        """ Calls the route matching a request, and returns its JSON encoded
+            response, or its EventStream, or None if no route matches.
+            Headers are looked up by their lowercased name.
+        """
+        handler = self.find(path.partition('?')[0])
+        if handler is not None:
+            if getattr(handler, '__headers__', False):
+                data = handler(read_params(path), headers or {})
+            else:
+                data = handler(read_params(path))
+            if isinstance(data, (bytes, EventStream, LongPoll)):
+                return data
+            return bytes(json.dumps(data) + '\n', encoding='utf-8')
+
+
+RESPONSE = ('HTTP/1.1 %d %s\r\n'
+            'Content-Type: application/json\r\n'
+            'Access-Control-Allow-Origin: *\r\n'
+            'Content-Length: %d\r\n'
+            'Connection: %s\r\n\r\n')
+
+
+def response(status, body, keep_alive=True):
+    """ A complete HTTP/1.1 response, ready to be written in one go. """
+    phrase = http.HTTPStatus(status).phrase
+    head = RESPONSE % (status, phrase, len(body), keep_alive and 'keep-alive' or 'close')
+    return bytes(head, encoding='latin-1') + body
+
+
+def error_body(status):
+    """ JSON body of an error response. """
+    return HTTPError(status).body()
+
+
+def drain_body(rfile, headers):
+    """ Reads and drops the body of a request, so that the next request on
+        the connection is read from its start.  Returns None, or the status
+        to answer and close the connection with if the body can't be
+        skipped: 501 for a Transfer-Encoding, 400 for a bad Content-Length.
+    """
+    if headers.get('transfer-encoding') is not None:
+        return 501
+    length = headers.get('content-length', '0')
+    if not length.isdigit():
+        return 400
+    length = int(length)
+    while length:
+        data = rfile.read(min(length, 65536))
+        if not data:
+            return 400
+        length -= len(data)
+
+
+def get(req_handler, router):
+    """ Map a request to the appropriate route of a Router, and answer it
+        with a single write.  The connection is kept alive if the
+        client allows it and no other connections are waiting for the server.
+    """
+    status = drain_body(req_handler.rfile, req_handler.headers)
+    if status is not None:
+        req_handler.wfile.write(response(status, error_body(status), False))
+        req_handler.close_connection = True
+        return
+    try:
+        data = router.dispatch(req_handler.path, req_handler.headers)
+        if isinstance(data, LongPoll):
+            data = wait(req_handler.server, data)
+    except HTTPError as e:
+        data = e
+    except Exception:
+        traceback.print_exc()
+        req_handler.wfile.write(response(500, error_body(500), False))
+        req_handler.close_connection = True
+        return
+    if data is OVERLOADED:
+        req_handler.wfile.write(OVERLOADED)
+        req_handler.close_connection = True
+        return
+    if isinstance(data, EventStream):
+        return stream(req_handler, data)
+    keep_alive = not req_handler.close_connection and not req_handler.server.busy()
+    if data is None:
+        data = response(404, error_body(404), keep_alive)
+    elif isinstance(data, HTTPError):
+        data = response(data.status, data.body(), keep_alive)
+    else:
+        data = response(200, data, keep_alive)
+    req_handler.wfile.write(data)
+    req_handler.close_connection = not keep_alive
+
+
+def wait(server, poll):
+    """ Waits out a LongPoll on the thread serving it, which counts as one
+        of the server's event streams, or returns OVERLOADED if the server
+        can't hold another one open.
+    """
+    if not server.add_stream(poll):
+        poll.close()
+        return OVERLOADED
+    try:
+        return poll.wait()
+    finally:
+        server.streams.discard(poll)
+
+
+def stream(req_handler, events):
+    """ Writes an EventStream to a client until either end closes it, with
+        a thread of its own feeding a WebSocket what the client sends, or
+        answers 503 if the server can't hold another stream open.
+    """
+    streams = req_handler.server.streams
+    req_handler.close_connection = True
+    if not req_handler.server.add_stream(events):
+        events.close()
+        req_handler.wfile.write(OVERLOADED)
+        return
+    reader = None
+    try:
+        if isinstance(events, WebSocket):
+            req_handler.connection.settimeout(None)
+            reader = threading.Thread(target=feed, args=(req_handler.rfile, events))
+            reader.daemon = True
+            reader.start()
+        chunk = events.head
+        while chunk is not None:
+            req_handler.wfile.write(chunk)
+            chunk = events.next()
+    except OSError:
+        pass
+    finally:
+        streams.discard(events)
+        events.close()
+        if reader is not None:
+            try:
+                req_handler.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            reader.join()
+
+
+def feed(rfile, websocket):
+    try:
+        while websocket.feed(rfile.read1(65536)):
+            pass
+    except (OSError, ValueError):
+        websocket.close()
+
+
+def parse_request(head):
+    """ Splits the head of a request into its method, target, version and a
+        dictionary of lowercased header names, or returns None if it is
+        malformed.
+    """
+    lines = head.decode('latin-1').split('\r\n')
+    request = lines[0].split(' ')
+    if len(request) != 3 or not request[2].startswith('HTTP/1.'):
+        return None
+    headers = {}
+    for line in lines[1:]:
+        name, colon, value = line.partition(':')
+        if colon:
+            headers[name.strip().lower()] = value.strip()
+    return request[0], request[1], request[2], headers
+
+
+def wants_keep_alive(version, headers):
+    """ HTTP/1.1 connections persist unless the client asks to close them,
+        HTTP/1.0 ones only if it asks to keep them alive.
+    """
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.0':
+        return connection == 'keep-alive'
+    return connection != 'close'
+
+
+class AsyncHTTPServer(object):
+    """ HTTP/1.1 server for a class whose methods have been decorated with
+        @route, serving every connection from a single asyncio event loop.
+        Connections are kept alive between requests, and closed after
+        `keep_alive` idle seconds, so thousands of polling clients cost a
+        socket each rather than a thread.  Routes are called on the loop, so
+        they should return quickly, except for requests that a route declares
+        blocking, which are answered from the loop's default executor.  A
+        LongPoll is awaited on the loop, so it holds no thread while it waits.
+
+        Mirrors the serve_forever() / shutdown() / server_close() interface
+        of the socketserver based servers.
+    """
+
+    def __init__(self, address, routes, keep_alive=KEEP_ALIVE):
+        self.router = Router(routes)
+        self.keep_alive = keep_alive
+        self.socket = socket.create_server(address, backlog=socket.SOMAXCONN)
+        self.server_address = self.socket.getsockname()
+        self._loop = None
+        self._stop = None
+        self._writers = set()
+        self._tasks = set()
+        self._streams = set()
+        self._started = threading.Event()
+        self._stopped = threading.Event()
+
+    def serve_forever(self):
+        self._stopped.clear()
+        try:
+            asyncio.run(self._serve_forever())
+        finally:
+            self._stopped.set()
+
+    async def _serve_forever(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = self._loop.create_future()
+        server = await asyncio.start_server(self._connection, sock=self.socket)
+        self._started.set()
+        try:
+            await self._stop
+        finally:
+            server.close()
+            self._started.clear()
+            for events in list(self._streams):
+                events.close()
+            for writer in list(self._writers):
+                writer.transport.abort()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def shutdown(self):
+        """ Stops serve_forever() and waits for it to return. """
+        if self._started.is_set():
+            self._loop.call_soon_threadsafe(self._stop.set_result, None)
+            self._stopped.wait()
+
+    def server_close(self):
+        self.socket.close()
+
+    async def _connection(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        timeout = loop.call_later(self.keep_alive, writer.transport.abort)
+        task = asyncio.current_task()
+        self._writers.add(writer)
+        self._tasks.add(task)
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    return
+                timeout.cancel()
+                keep_alive, data = await self._request(reader, head)
+                if isinstance(data, EventStream):
+                    return await self._stream(reader, writer, data)
+                writer.write(data)
+                await writer.drain()
+                if not keep_alive:
+                    return
+                timeout = loop.call_later(self.keep_alive, writer.transport.abort)
+        except ConnectionError:
+            pass
+        finally:
+            timeout.cancel()
+            writer.close()
+            self._writers.discard(writer)
+            self._tasks.discard(task)
+
+    async def _stream(self, reader, writer, events):
+        self._streams.add(events)
+        feeding = None
+        if isinstance(events, WebSocket):
+            feeding = asyncio.ensure_future(self._feed(reader, events))
+        try:
+            chunk = events.head
+            while chunk is not None:
+                writer.write(chunk)
+                await writer.drain()
+                chunk = await events.next_async()
+        finally:
+            self._streams.discard(events)
+            events.close()
+            if feeding is not None:
+                feeding.cancel()
+
+    async def _wait(self, poll):
+        self._streams.add(poll)
+        try:
+            return await poll.wait_async()
+        finally:
+            self._streams.discard(poll)
+
+    async def _feed(self, reader, websocket):
+        try:
+            while websocket.feed(await reader.read(65536)):
+                pass
+        except ConnectionError:
+            websocket.close()
+
+    async def _request(self, reader, head):
+        """ Answers one request, returning whether to keep the connection
+            alive and the response.
+        """
+        request = parse_request(head)
+        if request is None:
+            return False, response(400, error_body(400), False)
+        method, target, version, headers = request
+        if 'transfer-encoding' in headers:
+            return False, response(501, error_body(501), False)
+        length = headers.get('content-length', '0')
+        if not length.isdigit():
+            return False, response(400, error_body(400), False)
+        if int(length):
+            await reader.readexactly(int(length))
+        keep_alive = wants_keep_alive(version, headers)
+        if method != 'GET':
+            return keep_alive, response(405, error_body(405), keep_alive)
+        try:
+            if self.router.blocks(target):
+                data = await asyncio.get_running_loop().run_in_executor(None, self.router.dispatch, target, headers)
+            else:
+                data = self.router.dispatch(target, headers)
+            if isinstance(data, LongPoll):
+                data = await self._wait(data)
+        except HTTPError as e:
+            return keep_alive, response(e.status, e.body(), keep_alive)
+        except Exception:
+            traceback.print_exc()
+            return False, response(500, error_body(500), False)
+        if data is None:
+            return keep_alive, response(404, error_body(404), keep_alive)
+        if isinstance(data, EventStream):
+            return False, data
+        return keep_alive, response(200, data, keep_alive)
+
+
+def make_server(routes, host='0.0.0.0', port=8080, workers=WORKERS, queue_size=QUEUE_SIZE, backend=BACKEND):
+    """ Builds an HTTP server for a class whose methods have been decorated
+        with @route, served by a pool of `workers` threads, or a thread per
+        request if workers is None, or by an asyncio event loop if backend is
+        'asyncio'.
+    """
+    if backend == 'asyncio':
+        return AsyncHTTPServer((host, port), routes)
+    router = Router(routes)
+
     class RequestHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        @property
+        def timeout(self):
+            return self.server.keep_alive
+
         def log_message(self, *args, **kwargs):
             pass
 
         def do_GET(self):
-            get(self, routes)
+            get(self, router)
+
+    if workers is None:
+        return ThreadedHTTPServer((host, port), RequestHandler)
+    return PooledHTTPServer((host, port), RequestHandler, workers, queue_size)
+
 
-    server = ThreadedHTTPServer((host, port), RequestHandler)
+def run(routes, host='0.0.0.0', port=8080, workers=WORKERS, queue_size=QUEUE_SIZE, backend=BACKEND):
+    """ Runs a class as a server whose methods have been decorated with
+        @route.  Requests are served by a pool of `workers` threads with up
+        to `queue_size` connections waiting, or by a thread each if workers
+        is None, or by an asyncio event loop if backend is 'asyncio'.  On
+        Ctrl-C the server is shut down and then routes.close() called, if
+        it has one.
+    """
+    server = make_server(routes, host, port, workers, queue_size, backend)
     thread = threading.Thread(target=server.serve_forever)
     thread.daemon = True
     thread.start()
-    print('HTTP server started on port 8080')
-    while True:
-        from time import sleep
-        sleep(1)
-    server.shutdown()
-    server.start()
-    server.waitForThread()
+    print('HTTP server started on port %d' % port)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        close = getattr(routes, 'close', None)
+        if close is not None:
+            close()
 
 
 ################################################################################
@@ -326,82 +2689,357 @@ ops = {
 """
 
 
-class App(object):
-    """ The trading game server application. """
+QUOTES_HEAD = struct.Struct('<qH')  # sim time in ns since the epoch, number of quotes
+QUOTE = struct.Struct('<dIdI')  # bid price and size, ask price and size
 
-    def __init__(self):
-        self._book_1 = dict()
-        self._book_2 = dict()
-        self._data_1 = order_book(read_csv(), self._book_1, 'ABC')
-        self._data_2 = order_book(read_csv(), self._book_2, 'DEF')
-        self._rt_start = datetime.now()
-        self._sim_start, _, _ = next(self._data_1)
-        self.read_10_first_lines()
 
-    @property
-    def _current_book_1(self):
-        for t, bids, asks in self._data_1:
-            if REALTIME:
-                while t > self._sim_start + (datetime.now() - self._rt_start):
-                    yield t, bids, asks
-            else:
-                yield t, bids, asks
+def pack_quote(stock, bid, ask):
+    """ One quote of a binary WebSocket message: the stock name, as a length
+        byte and ASCII, then QUOTE, with a NaN price for a side with no
+        orders; a size may well be 0.
+    """
+    stock = stock.encode('ascii')
+    return bytes((len(stock),)) + stock + QUOTE.pack(*(bid or NO_QUOTE), *(ask or NO_QUOTE))
+
+
+def unpack_quotes(data):
+    """ Decodes a binary WebSocket message into (t, [(stock, bid, ask)]). """
+    ns, count = QUOTES_HEAD.unpack_from(data)
+    offset, quotes = QUOTES_HEAD.size, []
+    for _ in range(count):
+        length = data[offset]
+        stock = data[offset + 1:offset + 1 + length].decode('ascii')
+        bid_price, bid_size, ask_price, ask_size = QUOTE.unpack_from(data, offset + 1 + length)
+        offset += 1 + length + QUOTE.size
+        quotes.append((stock, None if math.isnan(bid_price) else (bid_price, bid_size),
+                       None if math.isnan(ask_price) else (ask_price, ask_size)))
+    return from_ns(ns), quotes
+
+
+def parse_timestamp(value):
+    """ Parses a timestamp of a request into a naive sim time, converting
+        one with a timezone to UTC.
+    """
+    t = parse_time(value)
+    if t.tzinfo is not None:
+        t = t.astimezone(timezone.utc).replace(tzinfo=None)
+    return t
+
+
+def parse_speed(speed):
+    """ A replay speed in sim seconds per real second, or None for 'step'. """
+    if speed == 'step':
+        return None
+    try:
+        speed = float(speed)
+    except ValueError:
+        speed = 0
+    if not 0 < speed < float('inf'):
+        raise HTTPError(400, 'speed must be a positive number or step')
+    return speed
+
+
+def parse_after(x):
+    """ The sim time of ?after= and the seconds of ?timeout= to wait for a
+        snapshot past it, or None and 0 without ?after=.
+    """
+    if not x or 'after' not in x:
+        return None, 0
+    try:
+        after = parse_timestamp(x['after'])
+    except (ValueError, OverflowError):
+        raise HTTPError(400, 'after must be a timestamp')
+    try:
+        timeout = float(x.get('timeout', LONG_POLL))
+    except ValueError:
+        timeout = -1
+    if not 0 <= timeout <= LONG_POLL:
+        raise HTTPError(400, 'timeout must be between 0 and %s seconds' % LONG_POLL)
+    return after, timeout
+
+
+def parse_batch(x):
+    """ The number of snapshots ?n= asks for, or None without it. """
+    if not x or 'n' not in x:
+        return None
+    try:
+        n = int(x['n'])
+    except ValueError:
+        n = 0
+    if not 0 < n <= BATCH:
+        raise HTTPError(400, 'n must be between 1 and %d' % BATCH)
+    return n
 
-    @property
-    def _current_book_2(self):
-        for t, bids, asks in self._data_2:
-            if REALTIME:
-                while t > self._sim_start + (datetime.now() - self._rt_start):
-                    yield t, bids, asks
-            else:
-                yield t, bids, asks
 
-    def read_10_first_lines(self):
-        for _ in iter(range(10)):
-            next(self._data_1)
-            next(self._data_2)
+class App(object):
+    """ The trading game server application, replaying the order history
+        of the CSV at `path` and keeping its tapes and checkpoint next to it.
+    """
 
-    @route('/query')
-    def handle_query(self, x):
+    def __init__(self, path='test.csv'):
+        self._speed = SIM_SPEED if REALTIME else None
+        def csv_orders(start=0):
+            return read_csv(path, start=start)
+
+        orders, exchange = (csv_orders, Exchange)
+        if REPLAY:
+            orders, exchange = (lambda: read_book(path)), TapeExchange
+        checkpoint = Checkpoint(path) if CHECKPOINT_EVERY and not REPLAY else None
+        self._engine = Engine(orders, self._speed, exchange=exchange, checkpoint=checkpoint).start()
+        self._encoded = None
+        self._packed = None
+        self._tape = BookTape(orders, exchange=exchange, path=path).load()
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    @route('/query', headers=True)
+    def handle_query(self, x, headers=None):
         """ Takes no arguments, and yields the current top of the book;  the
-            best bid and ask and their sizes
+            best bid and ask and their sizes.  A client naming a session,
+            with ?session= or an X-Session header, replays the book on its
+            own at ?speed= sim seconds per real second, or a step per query
+            with ?speed=step.  With ?after= the timestamp of a previous
+            answer, waits up to ?timeout= seconds, LONG_POLL at most, for
+            the book to move past it, as a LongPoll; stepping always moves
+            on.
+
+            With ?n= the answer is an array of up to n such arrays: the next
+            n steps, or a session's latest n changes since its previous
+            query, or else just the current top of the book.
+
+            With ?at= a timestamp, answers the top of the book as it was
+            then instead, found by binary search on the BookTape.
         """
+        after, timeout = parse_after(x)
+        n = parse_batch(x)
+        session = self._session(x, headers)
+        query_id = json.dumps((x or {}).get('id')).encode('utf-8')
         try:
-            t1, bids1, asks1 = next(self._current_book_1)
-            t2, bids2, asks2 = next(self._current_book_2)
-        except Exception as e:
-            print("error getting stocks...reinitalizing app")
-            self.__init__()
-            t1, bids1, asks1 = next(self._current_book_1)
-            t2, bids2, asks2 = next(self._current_book_2)
-        t = t1 if t1 > t2 else t2
-        print('Query received @ t%s' % t)
-        return [{
-            'id': x and x.get('id', None),
-            'stock': 'ABC',
-            'timestamp': str(t),
-            'top_bid': bids1 and {
-                'price': bids1[0][0],
-                'size': bids1[0][1]
-            },
-            'top_ask': asks1 and {
-                'price': asks1[0][0],
-                'size': asks1[0][1]
-            }
-        },
-            {
-                'id': x and x.get('id', None),
-                'stock': 'DEF',
+            self._engine.check()
+            if x and 'at' in x:
+                snapshots = [self._at(x['at'])]
+            elif session is not None:
+                return self._long_poll(session.poll(n or 1, after), query_id, n, timeout)
+            elif self._engine.stepped:
+                snapshots = self._engine.steps(n or 1)
+            elif after is not None:
+                return self._long_poll(self._engine.poll(after), query_id, n, timeout, self._engine.subscribe)
+            else:
+                snapshots = [self._engine.snapshot]
+        except EngineError as e:
+            raise HTTPError(503, str(e))
+        return self._answer(snapshots, query_id, n)
+
+    @route('/history', blocking=True)
+    def handle_history(self, x):
+        """ The top of the book of ?stock= each time it changed from ?from=
+            to ?to=, timestamps that both default to the ends of the order
+            history, found by binary search on time.  Blocking, as the first
+            call for a stock indexes the whole tape.  Answers a page of up to
+            ?limit= quotes starting at ?cursor=, the "cursor" of the previous
+            page, which is null on the last one.
+        """
+        x = x or {}
+        times, quotes = self._tape.history(x.get('stock'))
+        if not times:
+            raise HTTPError(404, 'unknown stock')
+        try:
+            start = bisect.bisect_left(times, parse_timestamp(x['from'])) if x.get('from') else 0
+            end = bisect.bisect_right(times, parse_timestamp(x['to'])) if x.get('to') else len(times)
+        except (ValueError, OverflowError):
+            raise HTTPError(400, 'from and to must be timestamps')
+        try:
+            limit = int(x.get('limit', HISTORY_LIMIT))
+            cursor = int(x.get('cursor', start))
+        except ValueError:
+            limit = cursor = -1
+        if not 0 < limit <= HISTORY_LIMIT:
+            raise HTTPError(400, 'limit must be between 1 and %d' % HISTORY_LIMIT)
+        if not start <= cursor <= max(start, end):
+            raise HTTPError(400, 'cursor out of range')
+        stop = min(cursor + limit, end)
+        return {
+            'stock': x['stock'],
+            'quotes': [{
                 'timestamp': str(t),
-                'top_bid': bids2 and {
-                    'price': bids2[0][0],
-                    'size': bids2[0][1]
+                'top_bid': bid and {
+                    'price': bid[0],
+                    'size': bid[1]
                 },
-                'top_ask': asks2 and {
-                    'price': asks2[0][0],
-                    'size': asks2[0][1]
+                'top_ask': ask and {
+                    'price': ask[0],
+                    'size': ask[1]
                 }
-            }]
+            } for t, (bid, ask) in zip(times[cursor:stop], quotes[cursor:stop])],
+            'cursor': stop if stop < end else None
+        }
+
+    @route('/stream')
+    def handle_stream(self, x):
+        """ Keeps the connection open and pushes a Server-Sent Event with the
+            top of the book of a stock, shaped like a /query quote without
+            the id, whenever it changes.  Every stock is sent on connecting.
+        """
+        sent = {}
+
+        def render(snapshot):
+            events = []
+            for (stock, bid, ask), quote in zip(snapshot.quotes, self._encode(snapshot)[2]):
+                if sent.get(stock, False) != (bid, ask):
+                    sent[stock] = bid, ask
+                    events.append(b'data: ' + quote + b'\n\n')
+            return b''.join(events)
+
+        return EventStream(self._engine.subscribe, render, self._engine.snapshot)
+
+    @route('/ws', headers=True)
+    def handle_ws(self, x, headers):
+        """ A WebSocket feed of the top of the book.  The client sends text
+            messages like {"subscribe": ["ABC"]} or {"unsubscribe": ["ABC"]},
+            and gets a binary message, see unpack_quotes(), with the quotes
+            of the stocks it subscribes to that have changed, and of the ones
+            it has just subscribed to.
+        """
+        state = {'stocks': frozenset()}
+        sent = {}
+
+        def render(snapshot):
+            stocks = state['stocks']
+            quotes = []
+            for stock, bid, ask in snapshot.quotes:
+                if stock in stocks and sent.get(stock, False) != (bid, ask):
+                    sent[stock] = bid, ask
+                    quotes.append(self._pack(snapshot, stock, bid, ask))
+            if not quotes:
+                return b''
+            return QUOTES_HEAD.pack(to_ns(snapshot.t), len(quotes)) + b''.join(quotes)
+
+        def receive(websocket, message):
+            try:
+                command = json.loads(message)
+                subscribe = set(command.get('subscribe', ()))
+                unsubscribe = set(command.get('unsubscribe', ()))
+            except (AttributeError, TypeError, ValueError):
+                websocket.send(websocket_frame(0x1, b'{"error": "bad command"}'))
+                return
+            for stock in subscribe:
+                sent.pop(stock, None)
+            state['stocks'] = (state['stocks'] | subscribe) - unsubscribe
+            websocket.refresh()
+
+        return WebSocket(headers, self._engine.subscribe, render, receive, self._engine.snapshot)
+
+    def close(self):
+        """ Stops the engine, which checkpoints its books on the way. """
+        self._engine.stop()
+
+    def _at(self, at):
+        """ The snapshot of the books at the sim time of ?at=. """
+        try:
+            at = parse_timestamp(at)
+        except (ValueError, OverflowError):
+            raise HTTPError(400, 'at must be a timestamp')
+        snapshot = self._tape.seek(at)
+        if snapshot is None:
+            raise HTTPError(404, 'no orders by then')
+        return snapshot
+
+    def _session(self, x, headers):
+        """ The session a query names, if any, created on first use. """
+        name = x and x.get('session') or headers and headers.get('x-session')
+        if not name:
+            return None
+        speed = parse_speed(x.get('speed')) if x and 'speed' in x else False
+        tape = self._tape.load()
+        with self._lock:
+            session = self._sessions.pop(name, None)
+            if session is None:
+                if speed is False:
+                    speed = self._speed
+                session = Session(tape, speed)
+            elif speed is not False and speed != session.speed:
+                session.set_speed(speed)
+            self._sessions[name] = session
+            while len(self._sessions) > SESSIONS:
+                self._sessions.popitem(last=False)
+        return session
+
+    def _answer(self, snapshots, query_id, n):
+        """ The /query response for some snapshots. """
+        answers = []
+        for snapshot in snapshots:
+            t, pieces, _ = self._encode(snapshot)
+            answers.append(query_id.join(pieces))
+        print('Query received @ t%s' % t)
+        if n is None:
+            return answers[0]
+        return b'[' + b', '.join(answer[:-1] for answer in answers) + b']\n'
+
+    def _long_poll(self, poll, query_id, n, timeout, subscribe=None):
+        """ The /query response for the snapshots poll() returns, at once
+            if it has them, or else a LongPoll for it, subscribed before the
+            first check so that no snapshot is missed.
+        """
+        def check(last=False):
+            try:
+                snapshots = poll(last)
+            except EngineError as e:
+                raise HTTPError(503, str(e))
+            return self._answer(snapshots, query_id, n) if isinstance(snapshots, list) else snapshots
+
+        long_poll = LongPoll(check, timeout, subscribe)
+        try:
+            data = check(not timeout)
+        except HTTPError:
+            long_poll.close()
+            raise
+        if isinstance(data, bytes):
+            long_poll.close()
+            return data
+        return long_poll
+
+    def _pack(self, snapshot, stock, bid, ask):
+        """ pack_quote() of a quote, kept until the next snapshot so that it
+            is packed once for every WebSocket.
+        """
+        packed = self._packed
+        if packed is None or packed[0] is not snapshot:
+            packed = self._packed = snapshot, {}
+        data = packed[1].get(stock)
+        if data is None:
+            data = packed[1][stock] = pack_quote(stock, bid, ask)
+        return data
+
+    def _encode(self, snapshot):
+        """ The JSON of every quote of a snapshot, and the /query response
+            split where the id of each quote goes, so that they are encoded
+            once however many clients read them.  Kept until the engine
+            publishes the next snapshot.
+        """
+        encoded = self._encoded
+        if encoded is not None and encoded[0] is snapshot:
+            return encoded[1]
+        t, quotes = snapshot
+        t = str(t)
+        quotes = [bytes(json.dumps({
+            'stock': stock,
+            'timestamp': t,
+            'top_bid': bid and {
+                'price': bid[0],
+                'size': bid[1]
+            },
+            'top_ask': ask and {
+                'price': ask[0],
+                'size': ask[1]
+            }
+        }), encoding='utf-8') for stock, bid, ask in quotes]
+        if quotes:
+            pieces = [b'[{"id": '] + [b', ' + quote[1:] + b', {"id": ' for quote in quotes[:-1]]
+            pieces.append(b', ' + quotes[-1][1:] + b']\n')
+        else:
+            pieces = [b'[]\n']
+        self._encoded = snapshot, (t, pieces, quotes)
+        return t, pieces, quotes
 
 
 ################################################################################
@@ -412,4 +3050,8 @@ if __name__ == '__main__':
     if not os.path.isfile('test.csv'):
         print("No data found, generating...")
         generate_csv()
-    run(App())
+    if sys.argv[1:] == ['build'] or REPLAY and open_book_tape('test.csv') is None:
+        print("Building the top of book tape...")
+        write_book_tape()
+    if sys.argv[1:] != ['build']:
+        run(App())
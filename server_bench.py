@@ -0,0 +1,354 @@
+""" Benchmarks for server3.  Runs every benchmark, or the ones named on the
+    command line, optionally with an argument:
+
+        python server_bench.py [read_csv tape memory=50000000 generate=10000000
+                                concurrency=2000 http=5000
+                                routing=100000 stream=2 deep_book=20000 ...]
+"""
+import csv
+import http.client
+import json
+import os
+import re
+import socket
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from itertools import islice
+from random import Random
+
+import dateutil.parser
+
+import server3
+
+
+def timed(f, *args):
+    """ Returns how many seconds f(*args) takes. """
+    start = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - start
+
+
+def bench_read_csv(repeat=50):
+    """ Timestamp parsing rows per second, dateutil vs parse_time(). """
+    with open('test.csv', 'rt') as f:
+        times = [row[0] for row in csv.reader(f)] * repeat
+
+    def parse_all(parse):
+        for t in times:
+            parse(t)
+
+    before = timed(parse_all, dateutil.parser.parse)
+    after = timed(parse_all, server3.parse_time)
+    print('parse dateutil      %12.0f rows/s' % (len(times) / before))
+    print('parse parse_time    %12.0f rows/s (%.1fx)' % (len(times) / after, before / after))
+    rows = len(times) // repeat
+    print('read_csv            %12.0f rows/s' % (rows / timed(list, server3.read_csv())))
+
+
+def bench_tape(repeat=100):
+    """ Startup and replay of the binary cache vs parsing the CSV text. """
+    scratch = tempfile.mkdtemp()
+    try:
+        path = os.path.join(scratch, 'test.csv')
+        with open('test.csv', 'rb') as src, open(path, 'wb') as dst:
+            rows = src.read()
+            for _ in range(repeat):
+                dst.write(rows)
+        rows = sum(1 for _ in open(path))
+        print('rows                %12d' % rows)
+        print('write_tape          %12.3f s' % timed(server3.write_tape, path))
+        print('open_tape           %12.3f ms' % (timed(server3.open_tape, path) * 1000))
+        text = timed(list, server3.read_text_csv(path))
+        tape = timed(list, server3.read_csv(path))
+        print('read text           %12.0f rows/s' % (rows / text))
+        print('read tape           %12.0f rows/s (%.1fx)' % (rows / tape, text / tape))
+    finally:
+        shutil.rmtree(scratch)
+
+
+def bench_generate(rows=10000000):
+    """ Orders per second from orders(market()) vs order_blocks(). """
+    rows = int(rows)
+    scalar = min(rows, 200000)
+    before = timed(list, zip(range(scalar), server3.orders(server3.market())))
+    print('orders(market())    %12.0f orders/s' % (scalar / before))
+
+    def generate():
+        count = 0
+        for t, _, _, _, _ in server3.order_blocks(seed=0):
+            count += len(t)
+            if count >= rows:
+                return
+
+    after = timed(generate)
+    print('order_blocks()      %12.0f orders/s (%.1fx), %d orders in %.2f s'
+          % (rows / after, before / scalar * rows / after, rows, after))
+
+    scratch = tempfile.mkdtemp()
+    try:
+        path = os.path.join(scratch, 'test.csv')
+        length = timedelta(days=365 * 5000)
+        for shards in sorted({1, os.cpu_count() or 1}):
+            took = timed(server3.generate_csv, path, length, rows, 0, shards)
+            print('generate_csv x%-4d  %12.0f rows/s' % (shards, rows / took))
+    finally:
+        shutil.rmtree(scratch)
+
+
+def hammer(f, clients, calls):
+    """ Calls f() `calls` times from each of `clients` threads, returning the
+        calls per second.
+    """
+    def client():
+        for _ in range(calls):
+            f()
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return clients * calls / (time.perf_counter() - start)
+
+
+def bench_concurrency(calls=2000):
+    """ App.handle_query() throughput from concurrent clients, in REALTIME
+        and in stepped mode.
+    """
+    calls = int(calls)
+    for realtime in (True, False):
+        server3.REALTIME = realtime
+        app = server3.App()
+        with open(os.devnull, 'w') as null, redirect_stdout(null):
+            rates = [(clients, hammer(lambda: app.handle_query(None), clients, calls // clients))
+                     for clients in (1, 4, 16, 64)]
+        app._engine.stop()
+        for clients, rate in rates:
+            print('%-8s x%-3d       %12.0f queries/s' % (realtime and 'realtime' or 'stepped', clients, rate))
+
+
+def serving(backend, workers=None):
+    """ Starts an App on a free port behind the given server backend, and
+        returns the server and its port.
+    """
+    server3.REALTIME = True
+    app = server3.App()
+    server = server3.make_server(app, '127.0.0.1', 0, workers, 1024, backend)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return app, server, server.server_address[1]
+
+
+def bench_http(calls=5000, idle=1000):
+    """ /query throughput over HTTP from concurrent polling clients, with and
+        without `idle` connections held open, for each server backend.
+        Clients keep their connections alive where the server lets them.  A
+        worker pool can't hold idle connections without starving, so it is
+        only run without them.
+    """
+    calls, idle = int(calls), int(idle)
+    backends = (('pool x%d' % server3.WORKERS, 'threads', server3.WORKERS),
+                ('thread/request', 'threads', None),
+                ('asyncio', 'asyncio', None))
+    for name, backend, workers in backends:
+        with open(os.devnull, 'w') as null, redirect_stdout(null):
+            app, server, port = serving(backend, workers)
+            rates = []
+            for held in (0, idle) if workers is None else (0,):
+                sockets = [socket.create_connection(('127.0.0.1', port)) for _ in range(held)]
+                for clients in (1, 16, 64):
+                    local = threading.local()
+
+                    def query():
+                        if not hasattr(local, 'conn'):
+                            local.conn = http.client.HTTPConnection('127.0.0.1', port)
+                        local.conn.request('GET', '/query?id=1')
+                        local.conn.getresponse().read()
+
+                    rates.append((held, clients, hammer(query, clients, calls // clients),
+                                  threading.active_count()))
+                for s in sockets:
+                    s.close()
+            server.shutdown()
+            server.server_close()
+            app._engine.stop()
+        for held, clients, rate, threads in rates:
+            print('%-15s x%-3d idle %-5d %10.0f queries/s %5d threads' % (name, clients, held, rate, threads))
+
+
+def bench_stream(seconds=2):
+    """ Top of book updates seen in `seconds` of realtime replay by a client
+        polling /query as fast as it can, vs one reading /stream, and the
+        process CPU time each costs.
+    """
+    seconds = float(seconds)
+    with open(os.devnull, 'w') as null, redirect_stdout(null):
+        app, server, port = serving('asyncio')
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port)
+            polls, changes, last = 0, 0, None
+            cpu, end = time.process_time(), time.monotonic() + seconds
+            while time.monotonic() < end:
+                conn.request('GET', '/query')
+                quotes = [(q['top_bid'], q['top_ask']) for q in json.loads(conn.getresponse().read())]
+                polls += 1
+                changes += quotes != last
+                last = quotes
+            poll_cpu = time.process_time() - cpu
+
+            sock = socket.create_connection(('127.0.0.1', port))
+            sock.sendall(b'GET /stream HTTP/1.1\r\n\r\n')
+            events, data = 0, b''
+            cpu, end = time.process_time(), time.monotonic() + seconds
+            sock.settimeout(0.1)
+            while time.monotonic() < end:
+                try:
+                    data += sock.recv(65536)
+                except socket.timeout:
+                    pass
+                *chunks, data = data.split(b'\n\n')
+                events += sum(chunk.startswith(b'data: ') for chunk in chunks)
+            stream_cpu = time.process_time() - cpu
+            sock.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+            app._engine.stop()
+    print('poll    %8d requests %8d changes  %6.2f s cpu' % (polls, changes, poll_cpu))
+    print('stream  %8d events              %6.2f s cpu' % (events, stream_cpu))
+
+
+def bench_routing(calls=100000):
+    """ Route lookups per second for a growing number of routes, scanning the
+        routes class with a regex per route vs the compiled Router.
+    """
+    calls = int(calls)
+    for count in (1, 10, 100):
+        routes = type('Routes', (object,), {
+            'handle_%d' % i: server3.route('/route%03d' % i)(lambda self, x: x) for i in range(count)})()
+        path = '/route%03d?id=1' % (count - 1)
+
+        def scan():
+            for _ in range(calls):
+                for name, handler in routes.__class__.__dict__.items():
+                    if hasattr(handler, "__route__") and re.search(handler.__route__, path):
+                        break
+
+        def compiled(router=server3.Router(routes)):
+            for _ in range(calls):
+                router.find(path.partition('?')[0])
+
+        before, after = timed(scan), timed(compiled)
+        print('%4d routes  scan %10.0f/s  router %10.0f/s (%.1fx)'
+              % (count, calls / before, calls / after, before / after))
+
+
+def crossed_orders(count, seed=1):
+    """ Random orders on a coarse price grid around 100, so the book stays
+        crossed and its levels grow deep.
+    """
+    rnd = Random(seed)
+    t = datetime(2019, 2, 1)
+    for _ in range(count):
+        t += timedelta(hours=rnd.random() * 24)
+        side = 'buy' if rnd.random() > 0.5 else 'sell'
+        yield t, 'ABC', side, round(rnd.gauss(100, 2) * 2) / 2, rnd.randint(1, 150)
+
+
+def bench_deep_book(orders=20000):
+    """ Orders per second through order_book() for each quarter of a run of
+        crossed orders that never expire within it, so the book, and the
+        crossed part of it, keeps growing.  With the ttl counting orders,
+        the late asks reached by the sweep have aged out and are skipped.
+    """
+    orders = int(orders)
+    quarter = orders // 4
+    for ttl in (orders // 2, timedelta(days=orders)):
+        stream = server3.order_book(crossed_orders(orders), server3.OrderBook(ttl), 'ABC')
+        rates = []
+        for _ in range(4):
+            def step():
+                for _, bids, asks in islice(stream, quarter):
+                    bids and bids[0], asks and asks[0]
+            rates.append(quarter / timed(step))
+        print('ttl %-18s %s orders/s' % (ttl, '  '.join('%8.0f' % rate for rate in rates)))
+
+
+def write_orders(path, rows):
+    """ Writes a CSV of `rows` orders from the market simulation, a second
+        apart so that long histories stay within the range of the cache's
+        epoch ns timestamps.
+    """
+    t0 = datetime(2019, 2, 1)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        for i, (_, stock, side, order, size) in zip(range(rows), server3.orders(server3.market())):
+            writer.writerow([t0 + timedelta(seconds=i), stock, side, order, size])
+
+
+def replay(path, cache):
+    """ Replays a CSV through an Exchange and prints the peak RSS in MB. """
+    import resource
+    exchange = server3.Exchange()
+    for _ in exchange.replay(server3.read_csv(path, cache)):
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024))
+
+
+def peak_rss(path, cache):
+    """ Runs replay() in a fresh process, so its peak RSS is the replay's. """
+    code = 'import server_bench; server_bench.replay(%r, %r)' % (path, cache)
+    here = os.path.dirname(os.path.abspath(__file__))
+    out = subprocess.run([sys.executable, '-c', code], cwd=here, check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True)
+    return float(out.stdout)
+
+
+def bench_memory(rows=50000000):
+    """ Peak RSS replaying generated histories of growing length, from the
+        text and from the binary cache.
+    """
+    rows = int(rows)
+    scratch = tempfile.mkdtemp()
+    try:
+        for n in (rows // 100, rows // 10, rows):
+            path = os.path.join(scratch, '%d.csv' % n)
+            write_orders(path, n)
+            text = peak_rss(path, False)
+            build = peak_rss(path, True)
+            tape = peak_rss(path, True)
+            print('%10d rows  %8.1f MB  text  %8.1f MB  build cache  %8.1f MB  cache'
+                  % (n, text, build, tape))
+            os.remove(path)
+            os.remove(server3.tape_path(path))
+    finally:
+        shutil.rmtree(scratch)
+
+
+BENCHES = {
+    'read_csv': bench_read_csv,
+    'tape': bench_tape,
+    'memory': bench_memory,
+    'generate': bench_generate,
+    'concurrency': bench_concurrency,
+    'http': bench_http,
+    'routing': bench_routing,
+    'stream': bench_stream,
+    'deep_book': bench_deep_book,
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHES:
+        name, _, arg = name.partition('=')
+        print('== %s' % name)
+        BENCHES[name](*[arg] if arg else [])
@@ -0,0 +1,1285 @@
+import asyncio
+import bisect
+import http.client
+import json
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import server3
+from datetime import datetime, timedelta
+from random import Random
+from server3 import (App, BookTape, Checkpoint, Engine, EngineError, EventStream, Exchange, HTTPError, LongPoll, OrderBook,
+                     Session, TapeExchange, WebSocket, add_book, book_tape_path, bwalk_block, clear_book, clear_order, generate_csv, make_server, match_book, numpy,
+                     open_book_tape, open_tape, order_blocks, order_book, parse_time, read_book, read_csv, read_params,
+                     read_text_csv, route, Router, tape_path, unpack_quotes, websocket_frame, write_book_tape)
+
+
+def sorted_order_book(orders, book, stock_name, age=10):
+  """ The original list based order_book(), kept as a reference. """
+  for t, stock, side, order, size in orders:
+    if stock_name == stock:
+      new = add_book(book.get(side, []), order, size, age)
+      book[side] = sorted(new, reverse=side == 'buy', key=lambda x: x[0])
+    bids, asks = clear_book(**{side: list(orders) for side, orders in book.items()})
+    yield t, bids, asks
+
+
+def crossed_orders(seed, count=2000):
+  """ Random orders on a coarse price grid, so that levels are shared and the
+      book is crossed most of the time.
+  """
+  rnd = Random(seed)
+  t = datetime(2019, 2, 1)
+  for _ in range(count):
+    t += timedelta(hours=rnd.random() * 24)
+    side = 'buy' if rnd.random() > 0.5 else 'sell'
+    yield t, 'ABC', side, round(rnd.gauss(100, 2) * 2) / 2, rnd.randint(1, 150)
+
+
+def as_lists(stream):
+  for t, bids, asks in stream:
+    yield t, bids if bids is None else list(bids), asks if asks is None else list(asks)
+
+
+@unittest.skipIf(numpy is None, 'needs numpy')
+class OrderBlocksTest(unittest.TestCase):
+  def test_bwalk_block_matchesBwalk(self):
+    steps = Random(3).choices([-40.0, -7.5, 0.25, 3.0, 55.0], k=500)
+    x, expected = 150.0, []
+    for step in steps:
+      x += step
+      expected.append(abs((x % 180.0) - 90.0) + 60.0)
+    walk, x = bwalk_block(numpy.array(steps[:250]), 60.0, 150.0, 150.0)
+    rest, _ = bwalk_block(numpy.array(steps[250:]), 60.0, 150.0, x)
+    numpy.testing.assert_allclose(numpy.concatenate([walk, rest]), expected)
+
+  def test_order_blocks_seeded(self):
+    first = next(order_blocks(seed=7, block=1000))
+    again = next(order_blocks(seed=7, block=1000))
+    for a, b in zip(first, again):
+      numpy.testing.assert_array_equal(a, b)
+
+  def test_order_blocks_distribution(self):
+    t, stock, side, price, size = next(order_blocks(seed=1, block=100000))
+    hours = numpy.diff(t).astype(numpy.int64) / 3.6e9
+    self.assertTrue(((hours >= 12) & (hours <= 36)).all())
+    self.assertAlmostEqual(stock.mean(), 0.5, delta=0.01)
+    self.assertAlmostEqual(side.mean(), 0.5, delta=0.01)
+    self.assertTrue((size >= 0).all())
+    self.assertAlmostEqual(size.mean(), 100 * (2 / numpy.pi) ** 0.5, delta=1)
+    self.assertTrue(((price > 50) & (price < 160)).all())
+    numpy.testing.assert_array_equal(price, numpy.round(price, 2))
+
+
+class GenerateCsvTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def generate(self, name, **kwargs):
+    path = os.path.join(self.dir, name)
+    generate_csv(path, t0=datetime(2019, 2, 1), seed=11, **kwargs)
+    return path, list(read_text_csv(path))
+
+  def test_generate_csv_coversLength(self):
+    _, rows = self.generate('test.csv', length=timedelta(days=365))
+    self.assertGreater(len(rows), 200)
+    self.assertLessEqual(rows[-1][0], datetime(2020, 2, 1))
+    self.assertEqual(sorted(rows), rows)
+    self.assertEqual({stock for _, stock, _, _, _ in rows}, {'ABC', 'DEF'})
+
+  def test_generate_csv_rows(self):
+    _, rows = self.generate('test.csv', rows=100)
+    self.assertEqual(len(rows), 100)
+
+  def test_generate_csv_shardsAreSeededAndInOrder(self):
+    path, rows = self.generate('a.csv', length=timedelta(days=730), shards=3)
+    again, _ = self.generate('b.csv', length=timedelta(days=730), shards=3)
+    with open(path, 'rb') as a, open(again, 'rb') as b:
+      self.assertEqual(a.read(), b.read())
+    self.assertEqual(sorted(rows), rows)
+    self.assertEqual(sorted(os.listdir(self.dir)), ['a.csv', 'b.csv'])
+
+
+class OrderBookTest(unittest.TestCase):
+  def test_order_book_matchesSortedBookOnTestData(self):
+    expected = as_lists(sorted_order_book(read_csv(), {}, 'DEF'))
+    actual = as_lists(order_book(read_csv(), OrderBook(), 'DEF'))
+    self.assertEqual(list(actual), list(expected))
+
+  def test_order_book_matchesSortedBookWhenCrossed(self):
+    for seed in range(5):
+      expected = as_lists(sorted_order_book(crossed_orders(seed), {}, 'ABC'))
+      actual = as_lists(order_book(crossed_orders(seed), OrderBook(), 'ABC'))
+      self.assertEqual(list(actual), list(expected))
+
+  def test_order_book_matchesSortedBookWithLongTtl(self):
+    expected = as_lists(sorted_order_book(crossed_orders(7, 600), {}, 'ABC', 150))
+    actual = as_lists(order_book(crossed_orders(7, 600), OrderBook(150), 'ABC'))
+    self.assertEqual(list(actual), list(expected))
+
+  def test_order_book_clearsLevelsLikeOrders(self):
+    def cleared(ttl, level_sweep):
+      sweep, server3.LEVEL_SWEEP = server3.LEVEL_SWEEP, level_sweep
+      try:
+        return list(as_lists(order_book(crossed_orders(3), OrderBook(ttl), 'ABC')))
+      finally:
+        server3.LEVEL_SWEEP = sweep
+    for ttl in (10, 150, 600, timedelta(days=10)):
+      self.assertEqual(cleared(ttl, 0), cleared(ttl, float('inf')))
+
+  def test_order_book_expiresOnSimTime(self):
+    t = datetime(2019, 2, 1)
+    book = OrderBook(timedelta(hours=2))
+    book.add('buy', 100.0, 10, t)
+    book.add('buy', 99.0, 10, t + timedelta(hours=1))
+    book.advance(t + timedelta(hours=2))
+    self.assertEqual(len(book.clear()[0]), 2)
+    book.advance(t + timedelta(hours=2, seconds=1))
+    bids, _ = book.clear()
+    self.assertEqual(list(bids), [(99.0, 10, timedelta(minutes=59, seconds=59))])
+    book.advance(t + timedelta(hours=4))
+    bids, _ = book.clear()
+    self.assertFalse(bids)
+
+  def test_order_book_topOfBook(self):
+    book = OrderBook()
+    book.add('buy', 100.0, 10)
+    book.add('buy', 101.0, 5)
+    book.add('sell', 103.0, 7)
+    book.add('sell', 102.0, 3)
+    bids, asks = book.clear()
+    self.assertEqual(bids[0], (101.0, 5, 10))
+    self.assertEqual(asks[0], (102.0, 3, 10))
+    self.assertEqual(list(bids), [(101.0, 5, 10), (100.0, 10, 9)])
+
+  def test_order_book_missingSideIsNone(self):
+    book = OrderBook()
+    book.add('sell', 103.0, 7)
+    bids, asks = book.clear()
+    self.assertIsNone(bids)
+    self.assertEqual(list(asks), [(103.0, 7, 10)])
+
+
+class ExchangeTest(unittest.TestCase):
+  def test_replay_matchesOrderBookPerStock(self):
+    exchange = Exchange()
+    books = {stock: as_lists(order_book(read_csv(), OrderBook(), stock)) for stock in ('ABC', 'DEF')}
+    for t in exchange.replay(read_csv()):
+      for stock, expected in books.items():
+        actual = next(as_lists([(t,) + exchange.clear(stock)]))
+        self.assertEqual(actual, next(expected))
+    self.assertEqual(exchange.stocks, ['ABC', 'DEF'])
+
+  def test_restore_carriesOnLikeTheSavedExchange(self):
+    for ttl in (10, timedelta(days=3)):
+      orders = list(crossed_orders(7))
+      orders += [(t, 'DEF', side, order, size) for t, _, side, order, size in crossed_orders(8)]
+      orders.sort()
+      exchange = Exchange(ttl)
+      expected = [exchange.quotes() for _ in exchange.replay(orders)]
+      exchange = Exchange(ttl)
+      for _ in exchange.replay(orders[:1500]):
+        pass
+      restored = Exchange.restore(*exchange.state())
+      self.assertEqual([restored.quotes() for _ in restored.replay(orders[1500:])], expected[1500:])
+
+  def test_clear_unknownStock(self):
+    self.assertEqual(Exchange().clear('XYZ'), (None, None))
+
+
+def wait_for(condition, timeout=5):
+  deadline = time.monotonic() + timeout
+  while not condition():
+    if time.monotonic() > deadline:
+      return False
+    time.sleep(0.001)
+  return True
+
+
+class EngineTest(unittest.TestCase):
+  def setUp(self):
+    t0 = datetime(2019, 2, 1)
+    self.orders = [(t0 + timedelta(seconds=i), 'ABC', ('buy', 'sell')[i % 2], 100.0 + i % 2, 10) for i in range(11)]
+    self.orders.append((t0 + timedelta(hours=1), 'ABC', 'buy', 100.5, 5))
+    self.orders.append((t0 + timedelta(days=365 * 1000), 'DEF', 'buy', 50.0, 5))
+
+  def test_engine_publishesWarmupSnapshot(self):
+    engine = Engine(lambda: self.orders, speed=1).start()
+    try:
+      self.assertEqual(engine.snapshot.t, self.orders[10][0])
+      self.assertEqual(engine.snapshot.quotes, (('ABC', (100.0, 10), (101.0, 10)),))
+    finally:
+      engine.stop()
+
+  def test_engine_followsSimClock(self):
+    engine = Engine(lambda: self.orders, speed=3600 * 100).start()
+    try:
+      self.assertTrue(wait_for(lambda: engine.snapshot.t == self.orders[11][0]))
+      self.assertEqual(engine.snapshot.quotes, (('ABC', (100.5, 5), (101.0, 10)),))
+      time.sleep(0.05)
+      self.assertEqual(engine.snapshot.t, self.orders[11][0])
+    finally:
+      engine.stop()
+
+  def test_engine_raisesWhenItsThreadDies(self):
+    with self.assertRaises(EngineError) as e:
+      Engine(lambda: [], speed=None).start()
+    self.assertIsInstance(e.exception.__cause__, ValueError)
+
+    def orders():
+      yield from self.orders[:12]
+      raise ValueError('bad row')
+
+    engine = Engine(orders, speed=None).start()
+    try:
+      self.assertEqual(engine.step().t, self.orders[11][0])
+      with self.assertRaises(EngineError) as e:
+        engine.step()
+      self.assertEqual(str(e.exception.__cause__), 'bad row')
+      with self.assertRaises(EngineError):
+        engine.steps(3)
+    finally:
+      engine.stop()
+
+  def test_engine_waitsForNewerSnapshot(self):
+    engine = Engine(lambda: self.orders, speed=3600 * 10).start()
+    try:
+      self.assertEqual(engine.wait(self.orders[10][0], 5).t, self.orders[11][0])
+      start = time.monotonic()
+      self.assertEqual(engine.wait(self.orders[11][0], 0.05).t, self.orders[11][0])
+      self.assertGreaterEqual(time.monotonic() - start, 0.05)
+    finally:
+      engine.stop()
+
+
+class SessionTest(unittest.TestCase):
+  def setUp(self):
+    t0 = datetime(2019, 2, 1)
+    self.orders = [(t0 + timedelta(hours=i), 'ABC', ('buy', 'sell')[i % 2], 100.0 + i % 2, 10) for i in range(14)]
+    self.tape = BookTape(lambda: self.orders).load()
+
+  def test_tape_matchesExchange(self):
+    exchange = Exchange()
+    expected = [(t, exchange.quotes()) for t in exchange.replay(self.orders)]
+    self.assertEqual(list(zip(self.tape.times, self.tape.snapshots)), [(t, (t, q)) for t, q in expected])
+
+  def test_session_stepsLikeEngine(self):
+    engine = Engine(lambda: self.orders, speed=None).start()
+    try:
+      expected = [engine.step() for _ in range(8)]
+    finally:
+      engine.stop()
+    session = Session(self.tape)
+    self.assertEqual([session.next() for _ in range(8)], expected)
+
+  def test_session_followsItsOwnClock(self):
+    session = Session(self.tape, speed=3600)
+    self.assertEqual(session.next(), self.tape.snapshots[10])
+    session._clock._rt_start -= 2.5
+    self.assertEqual(session.next(), self.tape.snapshots[12])
+    session.set_speed(None)
+    self.assertEqual(session.next(), self.tape.snapshots[13])
+    self.assertEqual(session.next(), self.tape.snapshots[11])
+    session.set_speed(3600)
+    session._clock._rt_start -= 5
+    self.assertEqual(session.next(), self.tape.snapshots[10])
+
+  def test_session_batch(self):
+    snapshots = self.tape.snapshots
+    session = Session(self.tape)
+    self.assertEqual(session.batch(2), snapshots[11:13])
+    self.assertEqual(session.batch(3), [snapshots[13], snapshots[11], snapshots[12]])
+    session = Session(self.tape, speed=3600)
+    self.assertEqual(session.batch(5), [snapshots[10]])
+    session._clock._rt_start -= 2.5
+    self.assertEqual(session.batch(5), snapshots[11:13])
+    self.assertEqual(session.batch(5), [snapshots[12]])
+    session = Session(self.tape, speed=3600)
+    session._clock._rt_start -= 2.5
+    self.assertEqual(session.batch(1), [snapshots[12]])
+
+  def test_tape_seeksLastSnapshotByThen(self):
+    tape = BookTape(read_csv).load()
+    rnd = Random(3)
+    for i in [0, 49, 50, 51, len(tape.times) - 1] + [rnd.randrange(len(tape.times)) for _ in range(20)]:
+      at = tape.times[i] + timedelta(microseconds=rnd.choice((0, 1)))
+      expected = [snapshot for snapshot in tape.snapshots if snapshot.t <= at][-1]
+      self.assertEqual(tape.seek(at), expected)
+    self.assertIsNone(tape.seek(tape.times[0] - timedelta(microseconds=1)))
+
+  def test_session_waitsForNewerSnapshot(self):
+    times = self.tape.times
+    session = Session(self.tape, speed=3600)
+    self.assertEqual(session.next(times[10], 0.01), self.tape.snapshots[10])
+    session._clock._rt_start -= 0.9
+    self.assertEqual(session.next(times[10], 5), self.tape.snapshots[11])
+    session._clock._rt_start -= 1.9
+    self.assertEqual(session.next(times[13], 5), self.tape.snapshots[10])
+    session.set_speed(None)
+    self.assertEqual(session.next(times[13], 5), self.tape.snapshots[11])
+
+
+class AppTest(unittest.TestCase):
+  def setUp(self):
+    realtime, server3.REALTIME = server3.REALTIME, False
+    every, server3.CHECKPOINT_EVERY = server3.CHECKPOINT_EVERY, None
+    try:
+      self.app = App()
+    finally:
+      server3.REALTIME = realtime
+      server3.CHECKPOINT_EVERY = every
+
+  def tearDown(self):
+    self.app._engine.stop()
+
+  def query(self, x=None, headers=None):
+    data = self.app.handle_query(x, headers)
+    if isinstance(data, LongPoll):
+      data = data.wait()
+    return json.loads(data)
+
+  def test_handle_query_503WhenRealtimeEngineDied(self):
+    self.app._engine.stop()
+    rows = list(read_csv())[:20]
+
+    def orders():
+      yield from rows
+      raise ValueError('bad row')
+
+    self.app._engine = Engine(orders, speed=3600 * 24 * 365).start()
+    self.assertTrue(wait_for(lambda: self.app._engine.error is not None))
+    for x in (None, {'after': str(rows[0][0]), 'timeout': '5'}, {'after': str(rows[-1][0]), 'timeout': '5'}):
+      with self.assertRaises(HTTPError) as e:
+        self.query(x)
+      self.assertEqual(e.exception.status, 503)
+    with self.assertRaises(EngineError):
+      self.app._engine.wait(rows[-1][0], 5)
+
+  def test_handle_query_stepsOneOrderPerQuery(self):
+    first = self.query({'id': '1'})
+    second = self.query({'id': '2'})
+    self.assertEqual([q['stock'] for q in first], ['ABC', 'DEF'])
+    self.assertEqual(first[0]['id'], '1')
+    self.assertEqual(first[0]['timestamp'], '2019-02-10 10:07:43.237974')
+    self.assertEqual(second[0]['timestamp'], '2019-02-11 18:12:31.763344')
+    self.assertIsNone(self.query({})[0]['id'])
+
+  def test_handle_query_503WhenEngineDied(self):
+    self.app._engine.stop()
+    self.app._engine.error = ValueError('bad row')
+    with self.assertRaises(HTTPError) as e:
+      self.query()
+    self.assertEqual(e.exception.status, 503)
+
+  def test_handle_query_concurrentClientsEachGetTheirOwnOrder(self):
+    stamps, errors = [], []
+
+    def client():
+      try:
+        for _ in range(100):
+          stamps.append(self.query()[0]['timestamp'])
+      except Exception as e:
+        errors.append(e)
+
+    clients = [threading.Thread(target=client) for _ in range(16)]
+    for c in clients:
+      c.start()
+    for c in clients:
+      c.join()
+    self.assertEqual(errors, [])
+    self.assertEqual(len(stamps), 1600)
+    self.assertEqual(len(set(stamps)), 1600)
+
+  def test_handle_query_encodesEachSnapshotOnce(self):
+    t0 = datetime(2019, 2, 1)
+    snapshot = server3.Snapshot(t0, (('ABC', (100.0, 10), None), ('DEF', None, (50.5, 3))))
+    self.app._engine.snapshot = snapshot
+    self.app._engine._speed = 1
+    first = self.app.handle_query({'id': 'a"1'})
+    pieces = self.app._encoded[1]
+    second = self.app.handle_query(None)
+    self.assertIs(self.app._encoded[1], pieces)
+    expected = [{'id': 'a"1', 'stock': 'ABC', 'timestamp': str(t0), 'top_bid': {'price': 100.0, 'size': 10},
+                 'top_ask': None},
+                {'id': 'a"1', 'stock': 'DEF', 'timestamp': str(t0), 'top_bid': None,
+                 'top_ask': {'price': 50.5, 'size': 3}}]
+    self.assertEqual(first, bytes(json.dumps(expected) + '\n', encoding='utf-8'))
+    for quote in expected:
+      quote['id'] = None
+    self.assertEqual(second, bytes(json.dumps(expected) + '\n', encoding='utf-8'))
+    self.app._engine.snapshot = server3.Snapshot(t0, ())
+    self.assertEqual(self.app.handle_query(None), b'[]\n')
+
+  def test_handle_stream_pushesChangedStocks(self):
+    events = self.app.handle_stream(None)
+    self.addCleanup(events.close)
+    first = [json.loads(e[6:]) for e in events.next().split(b'\n\n') if e]
+    self.assertEqual([e['stock'] for e in first], ['ABC', 'DEF'])
+    events._heartbeat = 0.01
+    quotes = {e['stock']: e for e in first}
+    for _ in range(50):
+      query = {q['stock']: q for q in self.query()}
+      pushed = events.next()
+      changed = {stock for stock, q in query.items()
+                 if (q['top_bid'], q['top_ask']) != (quotes[stock]['top_bid'], quotes[stock]['top_ask'])}
+      if changed:
+        pushed = [json.loads(e[6:]) for e in pushed.split(b'\n\n') if e]
+        self.assertEqual({e['stock'] for e in pushed}, changed)
+        for e in pushed:
+          quotes[e['stock']] = e
+          del query[e['stock']]['id']
+          self.assertEqual(e, query[e['stock']])
+      else:
+        self.assertEqual(pushed, EventStream.PING)
+
+  def test_handle_ws_sendsSubscribedStocks(self):
+    websocket = self.app.handle_ws(None, WS_HEADERS)
+    self.addCleanup(websocket.close)
+    websocket._heartbeat = 0.01
+    self.assertEqual(websocket.next(), WebSocket.PING)
+
+    def message():
+      data = websocket.next()
+      self.assertEqual(data[:2], b'\x82' + bytes((len(data) - 2,)))
+      return unpack_quotes(data[2:])
+
+    websocket.feed(client_frame(0x1, b'{"subscribe": ["DEF", "XYZ"]}'))
+    t, quotes = message()
+    snapshot = self.app._engine.snapshot
+    self.assertEqual((t, quotes), (snapshot.t, [q for q in snapshot.quotes if q[0] == 'DEF']))
+    seen = {'DEF': quotes[0]}
+    websocket.feed(client_frame(0x1, b'{"subscribe": ["ABC"], "unsubscribe": ["DEF"]}'))
+    for _ in range(30):
+      self.app.handle_query(None)
+      snapshot = self.app._engine.snapshot
+      data = websocket.next()
+      if data != WebSocket.PING:
+        t, quotes = unpack_quotes(data[2:])
+        self.assertEqual([q[0] for q in quotes], ['ABC'])
+        self.assertEqual(t, snapshot.t)
+        self.assertNotEqual(quotes[0], seen.get('ABC'))
+        seen['ABC'] = quotes[0]
+    self.assertIn('ABC', seen)
+    websocket.feed(client_frame(0x1, b'[1]'))
+    self.assertEqual(websocket.next(), b'\x81\x18{"error": "bad command"}')
+
+  def test_handle_query_sessionsReplayIndependently(self):
+    solo = [self.query()[0]['timestamp'] for _ in range(20)]
+    a, b = [], []
+    for i in range(20):
+      a.append(self.query({'session': 'a'})[0]['timestamp'])
+      if i % 2:
+        b.append(self.query({}, {'x-session': 'b'})[0]['timestamp'])
+    self.assertEqual(a, solo)
+    self.assertEqual(b, solo[:10])
+    self.assertEqual(self.query()[0]['timestamp'], self.query({'session': 'a'})[0]['timestamp'])
+
+  def test_handle_query_batch(self):
+    solo = [self.query({'id': '1'}) for _ in range(5)]
+    self.app._engine.stop()
+    self.setUp()
+    self.assertEqual(self.query({'id': '1', 'n': '3'}), solo[:3])
+    self.assertEqual(self.query({'id': '1', 'n': '2'}), solo[3:])
+    self.assertEqual(self.query({'session': 'a', 'n': '4'}), self.query({'session': 'b', 'n': '4'}))
+    self.app._engine._speed = 1
+    self.assertEqual(self.query({'n': '10'}), [self.query()])
+    for n in ('0', '-1', str(server3.BATCH + 1), 'many'):
+      with self.assertRaises(HTTPError) as e:
+        self.query({'n': n})
+      self.assertEqual(e.exception.status, 400)
+
+  def test_handle_query_after(self):
+    first = self.query()[0]['timestamp']
+    self.assertGreater(self.query({'after': first})[0]['timestamp'], first)
+    self.app._engine._speed = 1
+    snapshot = self.app._engine.snapshot
+    self.assertEqual(self.query({'after': str(snapshot.t), 'timeout': '0.01'})[0]['timestamp'], str(snapshot.t))
+    for x in ({'after': 'soon'}, {'after': first, 'timeout': '-1'}, {'after': first, 'timeout': '3600'},
+              {'after': first, 'timeout': 'nan'}):
+      with self.assertRaises(HTTPError) as e:
+        self.query(x)
+      self.assertEqual(e.exception.status, 400)
+
+  def test_handle_history_pagesChangesInRange(self):
+    tape = self.app._tape.load()
+    self.assertIsInstance(tape.snapshots, server3.Column)
+    quotes, last = [], None
+    for t, snapshot in tape.snapshots:
+      if snapshot[0][1:] != last:
+        last = snapshot[0][1:]
+        quotes.append((str(t), last))
+    whole = self.app.handle_history({'stock': 'ABC'})
+    self.assertEqual([(q['timestamp'], (q['top_bid'] and tuple(q['top_bid'].values()),
+                                        q['top_ask'] and tuple(q['top_ask'].values()))) for q in whole['quotes']],
+                     quotes[:server3.HISTORY_LIMIT])
+    x = {'stock': 'ABC', 'from': quotes[5][0], 'to': quotes[50][0].replace(' ', 'T') + '+00:00', 'limit': '20'}
+    pages = [self.app.handle_history(x)]
+    while pages[-1]['cursor'] is not None:
+      pages.append(self.app.handle_history(dict(x, cursor=str(pages[-1]['cursor']))))
+    self.assertEqual([len(page['quotes']) for page in pages], [20, 20, 6])
+    self.assertEqual([q for page in pages for q in page['quotes']], whole['quotes'][5:51])
+    for x in ({'stock': 'XYZ'}, {}):
+      with self.assertRaises(HTTPError) as e:
+        self.app.handle_history(x)
+      self.assertEqual(e.exception.status, 404)
+    self.assertEqual(list(self.app._tape._histories), ['ABC'])
+    self.assertTrue(Router(self.app).blocks('/history?stock=ABC'))
+    for x in ({'from': 'dawn'}, {'limit': '0'}, {'limit': 'all'}, {'cursor': str(len(quotes) + 1)}):
+      with self.assertRaises(HTTPError) as e:
+        self.app.handle_history(dict(x, stock='ABC'))
+      self.assertEqual(e.exception.status, 400)
+
+  def test_handle_query_replaysTopOfBookTape(self):
+    expected = [self.query({'id': '1', 'session': 'a'}) for _ in range(5)] + [self.query({'n': '5'})]
+    replay, server3.REPLAY = server3.REPLAY, True
+    try:
+      self.tearDown()
+      self.setUp()
+    finally:
+      server3.REPLAY = replay
+    self.assertIs(self.app._tape._exchange, TapeExchange)
+    self.assertEqual([self.query({'id': '1', 'session': 'a'}) for _ in range(5)] + [self.query({'n': '5'})], expected)
+
+  def test_handle_query_at(self):
+    stepped = [self.query({'id': '1'}) for _ in range(20)]
+    at = stepped[-1][0]['timestamp']
+    self.assertEqual(self.query({'id': '1', 'at': at}), stepped[-1])
+    self.assertEqual(self.query({'id': '1', 'at': at, 'n': '3'}), [stepped[-1]])
+    aware = (datetime.fromisoformat(at) + timedelta(hours=2)).isoformat() + '+02:00'
+    self.assertEqual(self.query({'id': '1', 'at': aware}), stepped[-1])
+    self.assertGreater(self.query({'after': at.replace(' ', 'T') + 'Z', 'timeout': '0'})[0]['timestamp'], at)
+    self.assertGreater(self.query()[0]['timestamp'], at)
+    with self.assertRaises(HTTPError) as e:
+      self.query({'at': 'then'})
+    self.assertEqual(e.exception.status, 400)
+    with self.assertRaises(HTTPError) as e:
+      self.query({'at': '2000-01-01 00:00:00'})
+    self.assertEqual(e.exception.status, 404)
+
+  def test_close_checkpointsEngine(self):
+    self.app.close()
+    folder = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, folder)
+    path = os.path.join(folder, 'test.csv')
+    shutil.copy('test.csv', path)
+    realtime, server3.REALTIME = server3.REALTIME, False
+    try:
+      self.app = App(path)
+    finally:
+      server3.REALTIME = realtime
+    stepped = [self.query() for _ in range(5)]
+    self.app.close()
+    self.assertEqual(Checkpoint(path).load()[1], 16)
+    realtime, server3.REALTIME = server3.REALTIME, False
+    try:
+      self.app = App(path)
+    finally:
+      server3.REALTIME = realtime
+    self.assertEqual(self.app._engine.snapshot.t, parse_time(stepped[-1][0]['timestamp']))
+
+  def test_handle_query_sessionSpeed(self):
+    first = self.query({'session': 'a', 'speed': str(3600 * 24 * 365 * 100)})[0]['timestamp']
+    time.sleep(0.01)
+    later = self.query({'session': 'a'})[0]['timestamp']
+    self.assertGreater(later, first)
+    stepped = self.query({'session': 'a', 'speed': 'step'})[0]['timestamp']
+    self.assertGreater(self.query({'session': 'a'})[0]['timestamp'], stepped)
+    for speed in ('0', '-1', 'fast', 'nan', 'inf'):
+      with self.assertRaises(HTTPError) as e:
+        self.query({'session': 'a', 'speed': speed})
+      self.assertEqual(e.exception.status, 400)
+
+
+class Routes(object):
+  def __init__(self):
+    self.entered = threading.Event()
+    self.release = threading.Event()
+    self.waits = []
+
+  @route('/echo')
+  def handle_echo(self, x):
+    return x
+
+  @route('/slow')
+  def handle_slow(self, x):
+    self.entered.set()
+    self.release.wait(5)
+    return {'slow': True}
+
+  @route('/events')
+  def handle_events(self, x):
+    return EventStream(self.subscribe, lambda value: b'data: %d\n\n' % value, 0)
+
+  def subscribe(self, callback):
+    self.push = callback
+    self.entered.set()
+    return lambda: None
+
+  @route('/ws', headers=True)
+  def handle_ws(self, x, headers):
+    def receive(websocket, message):
+      websocket.send(websocket_frame(0x1, message.upper().encode()))
+
+    return WebSocket(headers, self.subscribe, lambda value: b'%d' % value, receive, 0)
+
+  @route('/poll', blocking=('after', 'at'))
+  def handle_poll(self, x):
+    if x and 'after' in x:
+      self.entered.set()
+      self.release.wait(5)
+    return x
+
+  @route('/wait')
+  def handle_wait(self, x):
+    self.waits.append(x)
+    return LongPoll(lambda last: b'"done"\n' if last or self.release.is_set() else 0.01, 5)
+
+  @route('/fail')
+  def handle_fail(self, x):
+    raise HTTPError(400, 'bad id')
+
+  @route('/broken')
+  def handle_broken(self, x):
+    raise KeyError('oops')
+
+  @route('/header', headers=True)
+  def handle_header(self, x, headers):
+    return headers.get('x-session')
+
+  @route(r'^/items/\d+$')
+  def handle_item(self, x):
+    return 'item'
+
+  @route(r'/items/.')
+  def handle_items(self, x):
+    return 'items'
+
+  @route('/items/1')
+  def handle_first_item(self, x):
+    return 'first'
+
+
+class RouterTest(unittest.TestCase):
+  def test_router_plainPathsAreExact(self):
+    router = Router(Routes())
+    self.assertEqual(sorted(router.paths), ['/broken', '/echo', '/events', '/fail', '/header', '/items/1', '/poll', '/slow', '/wait', '/ws'])
+    self.assertEqual([p.pattern for p, _ in router.patterns], [r'^/items/\d+$', '/items/.'])
+    self.assertEqual(router.dispatch('/echo?id=1'), b'{"id": "1"}\n')
+    self.assertIsNone(router.dispatch('/echo/more'))
+    self.assertIsNone(router.dispatch('/api/echo'))
+
+  def test_router_patternsInDefinitionOrder(self):
+    router = Router(Routes())
+    self.assertEqual(router.dispatch('/items/1?id=3'), b'"first"\n')
+    self.assertEqual(router.dispatch('/items/12'), b'"item"\n')
+    self.assertEqual(router.dispatch('/items/12/x'), b'"items"\n')
+    self.assertIsNone(router.dispatch('/item'))
+
+  def test_router_blocks(self):
+    router = Router(Routes())
+    self.assertTrue(router.blocks('/poll?after=1'))
+    self.assertTrue(router.blocks('/poll?id=1&at=1'))
+    self.assertFalse(router.blocks('/poll?id=1'))
+    self.assertFalse(router.blocks('/poll'))
+    self.assertFalse(router.blocks('/slow?after=1'))
+    self.assertFalse(router.blocks('/missing?after=1'))
+
+  def test_read_params(self):
+    self.assertIsNone(read_params('/query'))
+    self.assertEqual(read_params('/query?'), {})
+    self.assertEqual(read_params('/query?id=1&flag&name=a%20b+c&eq=x=y'),
+                     {'id': '1', 'flag': '', 'name': 'a b c', 'eq': 'x=y'})
+
+
+def send_raw(port, data):
+  conn = socket.create_connection(('127.0.0.1', port))
+  conn.sendall(data)
+  return conn
+
+
+def send_get(port, path):
+  """ Opens a raw connection and sends a GET without reading the reply. """
+  return send_raw(port, b'GET %s HTTP/1.0\r\n\r\n' % path.encode())
+
+
+WS_HEADERS = {'upgrade': 'websocket', 'sec-websocket-version': '13', 'sec-websocket-key': 'dGhlIHNhbXBsZSBub25jZQ=='}
+
+
+def client_frame(opcode, payload=b'', fin=True, mask=b'\x01\x02\x03\x04'):
+  """ A masked frame, as a WebSocket client sends them. """
+  head = bytes((fin and 0x80 | opcode or opcode,))
+  if len(payload) < 126:
+    head += bytes((0x80 | len(payload),))
+  elif len(payload) < 1 << 16:
+    head += struct.pack('!BH', 0x80 | 126, len(payload))
+  else:
+    head += struct.pack('!BQ', 0x80 | 127, len(payload))
+  return head + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+
+
+def read_reply(conn):
+  reply = b''
+  while True:
+    data = conn.recv(65536)
+    if not data:
+      conn.close()
+      return reply
+    reply += data
+
+
+class ServerTest(unittest.TestCase):
+  """ The pooled server, and every backend through the subclasses below. """
+  long_polls = server3.STREAMS  # of the 40 in test_longPollsLeaveRoomForOtherRequests
+
+  def serve(self, **kwargs):
+    self.routes = Routes()
+    self.server = make_server(self.routes, '127.0.0.1', 0, **kwargs)
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    self.addCleanup(self.server.server_close)
+    self.addCleanup(self.server.shutdown)
+    self.addCleanup(self.routes.release.set)
+    return self.server.server_address[1]
+
+  def test_servesRoutes(self):
+    conn = http.client.HTTPConnection('127.0.0.1', self.serve())
+    conn.request('GET', '/echo?id=7')
+    reply = conn.getresponse()
+    self.assertEqual(reply.status, 200)
+    self.assertEqual(json.loads(reply.read()), {'id': '7'})
+
+  def test_keepsConnectionAlive(self):
+    conn = http.client.HTTPConnection('127.0.0.1', self.serve())
+    replies = []
+    for i in range(3):
+      conn.request('GET', '/echo?id=%d' % i)
+      reply = conn.getresponse()
+      replies.append((reply.status, reply.getheader('Connection'), json.loads(reply.read())))
+      if i == 0:
+        sock = conn.sock
+      self.assertIs(conn.sock, sock)
+    self.assertEqual(replies, [(200, 'keep-alive', {'id': str(i)}) for i in range(3)])
+
+  def test_pipelinedRequestsAnsweredInOrder(self):
+    conn = socket.create_connection(('127.0.0.1', self.serve()))
+    conn.sendall(b'GET /echo?id=1 HTTP/1.1\r\n\r\nGET /echo?id=2 HTTP/1.1\r\nConnection: close\r\n\r\n')
+    reply = read_reply(conn)
+    self.assertEqual(reply.count(b'HTTP/1.1 200 OK'), 2)
+    self.assertLess(reply.index(b'{"id": "1"}'), reply.index(b'{"id": "2"}'))
+    self.assertIn(b'Connection: close', reply)
+
+  def test_keptAliveRequestBodyIsSkipped(self):
+    port = self.serve()
+    reply = read_reply(send_raw(port, b'GET /echo?id=1 HTTP/1.1\r\nContent-Length: 5\r\n\r\nhello'
+                                      b'GET /echo?id=2 HTTP/1.1\r\nConnection: close\r\n\r\n'))
+    self.assertEqual(reply.count(b'HTTP/1.1 200 OK'), 2)
+    self.assertLess(reply.index(b'{"id": "1"}'), reply.index(b'{"id": "2"}'))
+    reply = read_reply(send_raw(port, b'GET /echo?id=1 HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+                                      b'5\r\nhello\r\n0\r\n\r\nGET /echo?id=2 HTTP/1.1\r\n\r\n'))
+    self.assertTrue(reply.startswith(b'HTTP/1.1 501 '))
+    self.assertIn(b'Connection: close\r\n', reply)
+    self.assertNotIn(b'{"id"', reply)
+
+  def test_longPollsLeaveRoomForOtherRequests(self):
+    port = self.serve()
+    polls = []
+    for i in range(40):
+      polls.append(send_raw(port, b'GET /wait HTTP/1.1\r\n\r\n'))
+      self.assertTrue(wait_for(lambda: len(self.routes.waits) > i))
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    start = time.monotonic()
+    conn.request('GET', '/echo?id=1')
+    self.assertEqual(json.loads(conn.getresponse().read()), {'id': '1'})
+    self.assertLess(time.monotonic() - start, 1)
+    conn.close()
+    self.routes.release.set()
+    replies = []
+    for poll in polls:
+      poll.settimeout(5)
+      replies.append(poll.recv(65536))
+      poll.close()
+    done = [reply for reply in replies if reply.startswith(b'HTTP/1.1 200 ')]
+    self.assertEqual(len(done), self.long_polls)
+    self.assertTrue(all(reply.endswith(b'"done"\n') for reply in done))
+    self.assertTrue(all(reply.startswith(b'HTTP/1.0 503 ') for reply in replies if reply not in done))
+
+  def test_http10ClosesAfterReply(self):
+    reply = read_reply(send_get(self.serve(), '/echo?id=1'))
+    self.assertTrue(reply.startswith(b'HTTP/1.1 200 OK\r\n'))
+    self.assertIn(b'Content-Length: 12\r\n', reply)
+    self.assertTrue(reply.endswith(b'{"id": "1"}\n'))
+
+  def test_unknownPathIs404(self):
+    conn = http.client.HTTPConnection('127.0.0.1', self.serve())
+    conn.request('GET', '/missing')
+    reply = conn.getresponse()
+    self.assertEqual((reply.status, reply.read()), (404, b'{"error": "not found"}\n'))
+    conn.request('GET', '/echo?id=3')
+    self.assertEqual(conn.getresponse().status, 200)
+
+  def test_routeErrorsAndHeaders(self):
+    conn = http.client.HTTPConnection('127.0.0.1', self.serve())
+    conn.request('GET', '/fail')
+    reply = conn.getresponse()
+    self.assertEqual((reply.status, reply.read()), (400, b'{"error": "bad id"}\n'))
+    conn.request('GET', '/header', headers={'X-Session': 'abc'})
+    reply = conn.getresponse()
+    self.assertEqual((reply.status, reply.read()), (200, b'"abc"\n'))
+
+  def test_unexpectedErrorIs500(self):
+    reply = read_reply(send_raw(self.serve(), b'GET /broken HTTP/1.1\r\n\r\n'))
+    self.assertTrue(reply.startswith(b'HTTP/1.1 500 '))
+    self.assertIn(b'Connection: close\r\n', reply)
+    self.assertTrue(reply.endswith(b'{"error": "internal server error"}\n'))
+
+  def test_streamsEventsUntilServerCloses(self):
+    conn = send_raw(self.serve(), b'GET /events HTTP/1.1\r\n\r\n')
+    conn.settimeout(5)
+    reply = b''
+    while not reply.endswith(b'data: 0\n\n'):
+      data = conn.recv(65536)
+      self.assertTrue(data)
+      reply += data
+    self.assertTrue(reply.startswith(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n'))
+    self.assertTrue(self.routes.entered.wait(5))
+    self.routes.push(1)
+    self.assertEqual(conn.recv(65536), b'data: 1\n\n')
+
+  def test_websocket(self):
+    port = self.serve()
+    conn = send_raw(port, b'GET /ws HTTP/1.1\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                          b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n')
+    conn.settimeout(5)
+    reply = b''
+    while not reply.endswith(b'\x82\x010'):
+      data = conn.recv(65536)
+      self.assertTrue(data)
+      reply += data
+    self.assertTrue(reply.startswith(b'HTTP/1.1 101 Switching Protocols\r\n'))
+    self.assertIn(b'Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=\r\n', reply)
+    self.assertTrue(self.routes.entered.wait(5))
+    self.routes.push(12)
+    self.assertEqual(conn.recv(65536), b'\x82\x0212')
+    conn.sendall(client_frame(0x1, b'hello'))
+    self.assertEqual(conn.recv(65536), b'\x81\x05HELLO')
+    conn.sendall(client_frame(0x8, b'\x03\xe8'))
+    self.assertEqual(read_reply(conn), b'\x88\x02\x03\xe8')
+
+  def test_websocketNeedsUpgrade(self):
+    conn = http.client.HTTPConnection('127.0.0.1', self.serve())
+    conn.request('GET', '/ws')
+    reply = conn.getresponse()
+    self.assertEqual((reply.status, reply.read()), (400, b'{"error": "expected a websocket upgrade"}\n'))
+
+  def test_longPollDoesNotHoldUpOtherClients(self):
+    port = self.serve()
+    polling = send_raw(port, b'GET /poll?after=1 HTTP/1.1\r\n\r\n')
+    self.assertTrue(self.routes.entered.wait(5))
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    conn.request('GET', '/poll?id=2')
+    self.assertEqual(json.loads(conn.getresponse().read()), {'id': '2'})
+    self.routes.release.set()
+    polling.settimeout(5)
+    self.assertTrue(polling.recv(65536).endswith(b'{"after": "1"}\n'))
+
+  def test_closesIdleConnections(self):
+    port = self.serve()
+    self.server.keep_alive = 0.05
+    conn = socket.create_connection(('127.0.0.1', port))
+    conn.settimeout(5)
+    self.assertEqual(conn.recv(1), b'')
+
+  def test_pool_rejectsOverflowWith503(self):
+    port = self.serve(workers=1, queue_size=1)
+    busy = send_get(port, '/slow')
+    self.assertTrue(self.routes.entered.wait(5))
+    queued = send_get(port, '/echo?id=1')
+    rejected = read_reply(send_get(port, '/echo?id=2'))
+    self.assertTrue(rejected.startswith(b'HTTP/1.0 503 '))
+    self.assertTrue(rejected.endswith(b'{"error": "server overloaded"}\n'))
+    self.routes.release.set()
+    self.assertIn(b'{"slow": true}', read_reply(busy))
+    self.assertIn(b'{"id": "1"}', read_reply(queued))
+
+  def test_pool_capsStreamsBelowWorkers(self):
+    port = self.serve(workers=4)
+    streams = []
+    for path in ('/events', '/events', '/ws'):
+      self.routes.entered.clear()
+      streams.append(send_raw(port, b'GET %s HTTP/1.1\r\nUpgrade: websocket\r\n'
+                                    b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n'
+                                    % path.encode()))
+      self.assertTrue(self.routes.entered.wait(5))
+    rejected = read_reply(send_get(port, '/events'))
+    self.assertTrue(rejected.startswith(b'HTTP/1.0 503 '))
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    conn.request('GET', '/echo?id=1')
+    self.assertEqual(json.loads(conn.getresponse().read()), {'id': '1'})
+    self.assertEqual(len(self.server.streams), 3)
+
+  def test_pool_letsKeptAliveConnectionGoWhenOthersWait(self):
+    port = self.serve(workers=1, queue_size=1)
+    busy = send_raw(port, b'GET /slow HTTP/1.1\r\n\r\n')
+    self.assertTrue(self.routes.entered.wait(5))
+    queued = send_get(port, '/echo?id=1')
+    time.sleep(0.05)
+    self.routes.release.set()
+    self.assertIn(b'Connection: close\r\n', read_reply(busy))
+    self.assertIn(b'{"id": "1"}', read_reply(queued))
+
+
+class ThreadServerTest(ServerTest):
+  long_polls = 40
+
+  def serve(self, **kwargs):
+    return ServerTest.serve(self, workers=None, **kwargs)
+
+  test_pool_rejectsOverflowWith503 = None
+  test_pool_capsStreamsBelowWorkers = None
+  test_pool_letsKeptAliveConnectionGoWhenOthersWait = None
+
+
+class AsyncServerTest(ServerTest):
+  long_polls = 40
+
+  def serve(self, **kwargs):
+    return ServerTest.serve(self, backend='asyncio', **kwargs)
+
+  test_pool_rejectsOverflowWith503 = None
+  test_pool_capsStreamsBelowWorkers = None
+  test_pool_letsKeptAliveConnectionGoWhenOthersWait = None
+
+  def test_errors(self):
+    conn = http.client.HTTPConnection('127.0.0.1', self.serve())
+    conn.request('POST', '/echo', body=b'ignored')
+    reply = conn.getresponse()
+    self.assertEqual(reply.status, 405)
+    reply.read()
+    conn.request('GET', '/echo?id=3')
+    self.assertEqual(conn.getresponse().status, 200)
+    self.assertEqual(read_reply(send_raw(self.server.server_address[1], b'nonsense\r\n\r\n'))[:12],
+                     b'HTTP/1.1 400')
+
+
+class EventStreamTest(unittest.TestCase):
+  def setUp(self):
+    self.unsubscribed = False
+    self.rendered = []
+
+  def subscribe(self, callback):
+    self.push = callback
+
+    def unsubscribe():
+      self.unsubscribed = True
+
+    return unsubscribe
+
+  def render(self, value):
+    self.rendered.append(value)
+    return b'data: %d\n\n' % value if value % 2 else b''
+
+  def test_conflatesToLatestValue(self):
+    events = EventStream(self.subscribe, self.render, 1)
+    for value in range(2, 8):
+      self.push(value)
+    self.assertEqual(events.next(), b'data: 7\n\n')
+    self.assertEqual(self.rendered, [7])
+
+  def test_pingsWhenNothingToSend(self):
+    events = EventStream(self.subscribe, self.render, heartbeat=0.01)
+    self.assertEqual(events.next(), EventStream.PING)
+    self.push(2)
+    self.assertEqual(events.next(), EventStream.PING)
+    self.assertEqual(self.rendered, [2])
+
+  def test_closeEndsStream(self):
+    events = EventStream(self.subscribe, self.render)
+    threading.Timer(0.01, events.close).start()
+    self.assertIsNone(events.next())
+    self.assertTrue(self.unsubscribed)
+
+  def test_next_async(self):
+    events = EventStream(self.subscribe, self.render, heartbeat=5)
+
+    async def read():
+      threading.Timer(0.01, self.push, (3,)).start()
+      first = await events.next_async()
+      threading.Timer(0.01, events.close).start()
+      return first, await events.next_async()
+
+    self.assertEqual(asyncio.run(read()), (b'data: 3\n\n', None))
+
+
+class WebSocketTest(unittest.TestCase):
+  def setUp(self):
+    self.received = []
+    self.websocket = WebSocket(WS_HEADERS, self.subscribe, lambda value: value, self.receive, heartbeat=0.01)
+
+  def subscribe(self, callback):
+    self.push = callback
+    return lambda: None
+
+  def receive(self, websocket, message):
+    self.received.append(message)
+
+  def test_websocket_frame(self):
+    self.assertEqual(websocket_frame(0x2, b'ab'), b'\x82\x02ab')
+    self.assertEqual(websocket_frame(0x2, b'a' * 200)[:4], b'\x82\x7e\x00\xc8')
+    self.assertEqual(websocket_frame(0x2, b'a' * 70000)[:10], b'\x82\x7f' + struct.pack('!Q', 70000))
+
+  def test_feed_splitAndFragmentedMessages(self):
+    data = (client_frame(0x1, 'héllo'.encode()) + client_frame(0x2, b'a' * 300, fin=False)
+            + client_frame(0x9, b'p') + client_frame(0x0, b'b'))
+    for i in range(0, len(data), 7):
+      self.assertTrue(self.websocket.feed(data[i:i + 7]))
+    self.assertEqual(self.received, ['héllo', b'a' * 300 + b'b'])
+    self.assertEqual(self.websocket.next(), b'\x8a\x01p')
+
+  def test_feed_rendersBinaryAndPings(self):
+    self.push(b'quote')
+    self.assertEqual(self.websocket.next(), b'\x82\x05quote')
+    self.assertEqual(self.websocket.next(), b'\x89\x00')
+
+  def test_feed_closeHandshake(self):
+    self.assertFalse(self.websocket.feed(client_frame(0x8, b'\x03\xe8bye')))
+    self.assertEqual(self.websocket.next(), b'\x88\x02\x03\xe8')
+    self.assertIsNone(self.websocket.next())
+
+  def test_unpack_quotes_keepsZeroSizes(self):
+    t = datetime(2019, 2, 1, 0, 30, 0, 966511)
+    quotes = [('ABC', (113.12, 0), None), ('DEF', None, (50.5, 3))]
+    data = struct.pack('<qH', server3.to_ns(t), 2) + b''.join(server3.pack_quote(*q) for q in quotes)
+    self.assertEqual(unpack_quotes(data), (t, quotes))
+
+  def test_feed_protocolErrors(self):
+    for data, code in ((b'\x81\x00', 1002), (client_frame(0x0, b'x'), 1002), (client_frame(0x3), 1002),
+                       (client_frame(0x1, b'\xff'), 1007), (client_frame(0x2, b'x' * 70000), 1009),
+                       (client_frame(0x2, b'x' * 40000, fin=False) + client_frame(0x0, b'x' * 40000), 1009)):
+      websocket = WebSocket(WS_HEADERS, self.subscribe, lambda value: value, self.receive)
+      self.assertFalse(websocket.feed(data))
+      self.assertEqual(websocket.next(), b'\x88\x02' + struct.pack('!H', code))
+
+  def test_handshakeNeedsUpgrade(self):
+    for headers in ({}, dict(WS_HEADERS, upgrade='h2c'), dict(WS_HEADERS, **{'sec-websocket-version': '8'})):
+      with self.assertRaises(HTTPError):
+        WebSocket(headers, self.subscribe, lambda value: value, self.receive)
+
+
+class ClearOrderTest(unittest.TestCase):
+  def test_clear_order_partialFill(self):
+    book = [(100.0, 10, 3), (101.0, 5, 2), (102.0, 7, 0), (103.0, 1, 4)]
+    notional, new_book = clear_order(101.5, 12, book)
+    self.assertEqual(notional, 10 * 100.0 + 2 * 101.0)
+    self.assertIs(new_book, book)
+    self.assertEqual(book, [(101.0, 3, 2), (103.0, 1, 3)])
+
+  def test_clear_order_unfilledLeavesBookUntouched(self):
+    book = [(100.0, 10, 3), (101.0, 5, 2)]
+    self.assertIsNone(clear_order(100.5, 12, book))
+    self.assertIsNone(clear_order(101.0, 15, book))
+    self.assertEqual(book, [(100.0, 10, 3), (101.0, 5, 2)])
+
+  def test_clear_order_sweepsDeepBook(self):
+    book = [(100.0 + i / 100, 1, 10) for i in range(20000)]
+    notional, book = clear_order(1000.0, 19999, book)
+    self.assertEqual(book, [(299.99, 1, 10)])
+    self.assertAlmostEqual(notional, sum(100.0 + i / 100 for i in range(19999)))
+
+  def test_clear_book_inPlace(self):
+    buy = [(101.0, 4, 5), (100.8, 4, 5), (99.0, 4, 5)]
+    sell = [(99.5, 6, 5), (100.5, 10, 5)]
+    bids, asks = clear_book(buy, sell)
+    self.assertIs(bids, buy)
+    self.assertIs(asks, sell)
+    self.assertEqual(bids, [(99.0, 4, 5)])
+    self.assertEqual(asks, [(100.5, 8, 4)])
+
+
+class ReadCsvTest(unittest.TestCase):
+  def test_parse_time_fixedFormat(self):
+    self.assertEqual(parse_time('2019-02-01 00:30:00.966511'), datetime(2019, 2, 1, 0, 30, 0, 966511))
+    self.assertEqual(parse_time('2019-02-01 00:30:00'), datetime(2019, 2, 1, 0, 30))
+
+  def test_parse_time_fallsBackToDateutil(self):
+    self.assertEqual(parse_time('Feb 1 2019 00:30'), datetime(2019, 2, 1, 0, 30))
+
+  def test_read_csv(self):
+    rows = list(read_csv())
+    self.assertEqual(len(rows), 1832)
+    self.assertEqual(rows[0], (datetime(2019, 2, 1, 0, 30, 0, 966511), 'ABC', 'buy', 118.24, 21))
+
+
+class TapeCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'test.csv')
+    shutil.copy('test.csv', self.path)
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_read_csv_writesAndReadsCache(self):
+    expected = list(read_text_csv(self.path))
+    self.assertEqual(list(read_csv(self.path)), expected)
+    self.assertTrue(os.path.isfile(tape_path(self.path)))
+    self.assertIsNotNone(open_tape(self.path))
+    self.assertEqual(list(read_csv(self.path)), expected)
+
+  def test_read_csv_streamsInChunks(self):
+    chunk, server3.TAPE_CHUNK = server3.TAPE_CHUNK, 100
+    try:
+      expected = list(read_text_csv(self.path))
+      self.assertEqual(list(read_csv(self.path)), expected)
+      self.assertEqual(list(read_csv(self.path)), expected)
+    finally:
+      server3.TAPE_CHUNK = chunk
+
+  def test_read_csv_keepsCacheWhenOnlyMtimeChanges(self):
+    list(read_csv(self.path))
+    cached = os.stat(tape_path(self.path)).st_ino
+    stat = os.stat(self.path)
+    os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    self.assertIsNotNone(open_tape(self.path))
+    self.assertEqual(os.stat(tape_path(self.path)).st_ino, cached)
+
+  def test_read_csv_rebuildsStaleCache(self):
+    list(read_csv(self.path))
+    with open(self.path, 'r+') as f:
+      f.seek(0)
+      f.write('2019-02-01 00:30:00.966511,XYZ,buy,118.24,21\n')
+    stat = os.stat(self.path)
+    os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    self.assertIsNone(open_tape(self.path))
+    self.assertEqual(next(read_csv(self.path))[1], 'XYZ')
+
+
+class BookTapeFileTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'test.csv')
+    orders = sorted(list(crossed_orders(1, 500)) + [(t, 'AAA', side, order, size)
+                                                    for t, _, side, order, size in crossed_orders(2, 500)][250:])
+    with open(self.path, 'w') as f:
+      for t, stock, side, order, size in orders:
+        f.write('%s,%s,%s,%s,%s\n' % (t, stock, side, order, size))
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_write_book_tape_matchesExchange(self):
+    expected = list(match_book(read_text_csv(self.path)))
+    self.assertEqual(expected[0][1][0][0], 'ABC')
+    self.assertEqual(expected[-1][1][0][0], 'AAA')
+    for chunk in (server3.TAPE_CHUNK, 100):
+      chunk, server3.TAPE_CHUNK = server3.TAPE_CHUNK, chunk
+      try:
+        self.assertTrue(write_book_tape(self.path))
+        self.assertEqual(list(read_book(self.path)), expected)
+      finally:
+        server3.TAPE_CHUNK = chunk
+
+  def test_read_book_matchesExchangeOnTestData(self):
+    path = os.path.join(self.dir, 'orders.csv')
+    shutil.copy('test.csv', path)
+    self.assertIn(0, [size for _, _, _, _, size in read_csv(path)])
+    self.assertEqual(list(read_book(path)), list(match_book(read_csv(path))))
+
+  def test_read_book_buildsTapeOnceAndRebuildsStaleOne(self):
+    expected = list(read_book(self.path))
+    built = os.stat(book_tape_path(self.path)).st_ino
+    self.assertEqual(list(read_book(self.path)), expected)
+    self.assertEqual(os.stat(book_tape_path(self.path)).st_ino, built)
+    with open(self.path, 'a') as f:
+      f.write('2030-01-01 00:00:00,XYZ,buy,1.5,2\n')
+    self.assertIsNone(open_book_tape(self.path))
+    self.assertEqual(list(read_book(self.path))[-1][1][-1], ('XYZ', (1.5, 2), None))
+
+  def test_book_tape_mapsTapeLikeMatchedOne(self):
+    matched = BookTape(lambda: read_csv(self.path)).load()
+    mapped = BookTape(lambda: read_csv(self.path), path=self.path).load()
+    self.assertIsInstance(mapped.snapshots, server3.Column)
+    self.assertTrue(os.path.exists(book_tape_path(self.path)))
+    self.assertEqual(list(mapped.times), matched.times)
+    self.assertEqual(list(mapped.snapshots), matched.snapshots)
+    self.assertEqual(mapped.snapshots[-3:], matched.snapshots[-3:])
+    self.assertEqual(bisect.bisect_right(mapped.times, matched.times[300]), bisect.bisect_right(matched.times, matched.times[300]))
+    self.assertEqual(mapped.stocks, {'ABC', 'AAA'})
+    self.assertEqual(mapped.stocks, matched.stocks)
+    for stock in ('ABC', 'AAA', 'XYZ'):
+      self.assertEqual(mapped.history(stock), matched.history(stock))
+    session = Session(mapped)
+    self.assertEqual([session.next() for _ in range(3)], matched.snapshots[11:14])
+
+  def test_engine_replaysTapeWithoutMatching(self):
+    write_book_tape(self.path)
+    matching = Engine(lambda: read_csv(self.path), speed=None).start()
+    replaying = Engine(lambda: read_book(self.path), speed=None, exchange=TapeExchange).start()
+    try:
+      self.assertEqual(replaying.snapshot, matching.snapshot)
+      self.assertEqual(replaying.steps(100), matching.steps(100))
+    finally:
+      matching.stop()
+      replaying.stop()
+
+
+class CheckpointTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'test.csv')
+    shutil.copy('test.csv', self.path)
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def engine(self, checkpoint=None):
+    return Engine(lambda start=0: read_csv(self.path, start=start), speed=None, checkpoint=checkpoint).start()
+
+  def test_engine_resumesFromCheckpoint(self):
+    engine = self.engine()
+    try:
+      expected = engine.steps(300)
+    finally:
+      engine.stop()
+    checkpoint = Checkpoint(self.path, every=100)
+    engine = self.engine(checkpoint)
+    try:
+      self.assertEqual(engine.steps(150), expected[:150])
+      self.assertEqual(checkpoint.load()[1], 100)
+    finally:
+      engine.stop()
+    self.assertEqual(checkpoint.load()[1], 161)
+    engine = self.engine(checkpoint)
+    try:
+      self.assertEqual(engine.snapshot, expected[149])
+      self.assertEqual(engine.steps(150), expected[150:])
+    finally:
+      engine.stop()
+
+  def test_load_rejectsStaleCheckpoint(self):
+    checkpoint = Checkpoint(self.path)
+    self.assertIsNone(checkpoint.load())
+    for ttl in (timedelta(days=1), 10):
+      exchange = Exchange(ttl)
+      for _ in exchange.replay(read_csv(self.path, start=0)):
+        pass
+      self.assertTrue(checkpoint.save(exchange, 1832))
+      restored, rows = checkpoint.load(ttl)
+      self.assertEqual((restored.t, restored.quotes(), rows), (exchange.t, exchange.quotes(), 1832))
+    self.assertIsNone(checkpoint.load(ttl=timedelta(days=1)))
+    self.assertIsNone(checkpoint.load(ttl=5))
+    with open(self.path, 'a') as f:
+      f.write('2030-01-01 00:00:00,XYZ,buy,1.5,2\n')
+    self.assertIsNone(checkpoint.load())
+
+
+if __name__ == '__main__':
+  unittest.main()